@@ -14,12 +14,12 @@ import certifi
 import subprocess
 import json
 #import math
-import uuid
 import shutil
 #from multiprocessing import Process, Lock
 import time
 import hashlib
 import glob
+from mapstore import store_tiles
 
 # GLOBALS
 args = object
@@ -75,46 +75,54 @@ class MBTiles():
          raise RuntimeError("Metadata name not found")
 
    def SetTile(self, zoomLevel, tileColumn, tileRow, data):
-      tile_id = self.TileExists(zoomLevel, tileColumn, tileRow)
-      if tile_id: 
-         tile_id = uuid.uuid4().hex
-         operation = 'update images'
-         self.c.execute("DELETE FROM images  WHERE tile_id = ?;", ([tile_id]))
-         self.c.execute("INSERT INTO images (tile_data,tile_id) VALUES ( ?, ?);", (sqlite3.Binary(data),tile_id))
-         if self.c.rowcount != 1:
-            raise RuntimeError("Failure %s RowCount:%s"%(operation,self.c.rowcount))
+      # images are content addressed, so identical tiles share one row
+      tile_id = hashlib.md5(data).hexdigest()
+      old_id = self.TileExists(zoomLevel, tileColumn, tileRow)
+      if old_id == tile_id:
+         return
+      self.c.execute("INSERT OR IGNORE INTO images (tile_data,tile_id) VALUES ( ?, ?);", (sqlite3.Binary(data),tile_id))
+      if old_id: 
+         operation = 'update map'
          self.c.execute("""UPDATE map SET tile_id=? where zoom_level = ? AND 
                tile_column = ? AND tile_row = ?;""", 
             (tile_id, zoomLevel, tileColumn, tileRow))
-         if self.c.rowcount != 1:
-            raise RuntimeError("Failure %s RowCount:%s"%(operation,self.c.rowcount))
-         self.conn.commit()
-         return
       else: # this is not an update
-         tile_id = uuid.uuid4().hex
-         self.c.execute("INSERT INTO images ( tile_data,tile_id) VALUES ( ?, ?);", (sqlite3.Binary(data),tile_id))
-         if self.c.rowcount != 1:
-            raise RuntimeError("Insert image failure")
          operation = 'insert into map'
          self.c.execute("INSERT INTO map (zoom_level, tile_column, tile_row, tile_id) VALUES (?, ?, ?, ?);", 
             (zoomLevel, tileColumn, tileRow, tile_id))
       if self.c.rowcount != 1:
          raise RuntimeError("Failure %s RowCount:%s"%(operation,self.c.rowcount))
+      if old_id:
+         self.release_images([old_id])
       self.conn.commit()
    
+   def release_images(self, tile_ids):
+      # drop images that no map row refers to any longer, keeping the blank
+      # tiles download.py files refer to from blank_tiles
+      sql = """DELETE FROM images WHERE tile_id = ? AND
+            NOT EXISTS (SELECT 1 FROM map WHERE map.tile_id = images.tile_id)"""
+      if self.c.execute("SELECT count(*) FROM sqlite_master WHERE name = 'blank_tiles'").fetchone()[0]:
+         sql += " AND NOT EXISTS (SELECT 1 FROM blank_tiles WHERE blank_tiles.tile_id = images.tile_id)"
+      self.c.executemany(sql, [(tile_id,) for tile_id in tile_ids])
+
+   def set_tiles(self, tiles):
+      # write a batch of (zoom_level, tile_column, tile_row, tile_data) in one transaction
+      # (mapstore.store_tiles is shared with download.TileWriter)
+      latest = {}
+      for zoomLevel, tileColumn, tileRow, data in tiles:
+         latest[(zoomLevel, tileColumn, tileRow)] = (hashlib.md5(data).hexdigest(), data)
+      old_ids = store_tiles(self.c, latest)
+      self.release_images(old_ids)
+      self.conn.commit()
+      return len(latest)
 
    def DeleteTile(self, zoomLevel, tileColumn, tileRow):
       tile_id = self.TileExists(zoomLevel, tileColumn, tileRow)
       if not tile_id:
          return
-      try:
-         self.c.execute("DELETE FROM images WHERE tile_id = ?;",(tile_id,)) 
-      except:
-         pass
-      try:
-         self.c.execute("DELETE FROM map WHERE tile_id = ?;",(tile_id,)) 
-      except:
-         pass
+      self.c.execute("DELETE FROM map WHERE zoom_level = ? AND tile_column = ? AND tile_row = ?;",
+         (zoomLevel, tileColumn, tileRow)) 
+      self.release_images([tile_id])
       self.conn.commit()
 
    def TileExists(self, zoomLevel, tileColumn, tileRow):
@@ -186,9 +194,16 @@ def chop_zoom_and_below(max_to_chop):
       except Exception as e:
          print('DeleteTile in chop_xoom error:%s'%e)
          sys.exit(1)
-   print('vacumming database')
-   db.c.execute('vacuum')
+   # no full vacuum: an INCREMENTAL file hands its free pages back here,
+   # otherwise they stay for reuse (download.py --vacuum-into compacts a copy)
    db.Commit()
+   free = db.c.execute('PRAGMA freelist_count').fetchone()[0]
+   if db.c.execute('PRAGMA auto_vacuum').fetchone()[0] == 2:
+      db.c.execute('PRAGMA incremental_vacuum').fetchall()
+      db.Commit()
+      print('released %s free pages'%free)
+   else:
+      print('%s free pages left in %s'%(free,dbname))
    
 def get_regions():
    global regions
@@ -228,16 +243,20 @@ def sec2hms(n):
 def copy_if_new(src,dest):
    src_db = MBTiles(src)
    dest_db = MBTiles(dest)
+   start = time.time()
+   copied = 0
    #for zoom in range(0,14):
    for zoom in range(0,3):
       sql = "SELECT * from tiles where zoom_level = ?"
       src_db.c = src_db.c.execute(sql,(zoom,))
       while True:
-         rows = src_db.c.fetchmany(100)
+         rows = src_db.c.fetchmany(500)
          if not rows: break
-         for row in rows:
-            dest_db.SetTile(row['zoom_level'],row['tile_column'],\
-               row['tile_row'],row['tile_data'])
+         copied += dest_db.set_tiles((row['zoom_level'],row['tile_column'],\
+               row['tile_row'],row['tile_data']) for row in rows)
+   elapsed = time.time() - start
+   if elapsed > 0:
+      print('copied %s tiles from %s in %2.1f seconds (%2.1f tiles/s)'%(copied,src,elapsed,copied/elapsed))
   
 def get_src_list(selected):
    get_regions()
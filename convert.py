@@ -0,0 +1,113 @@
+#!/usr/bin/env python2
+# -*- coding: UTF-8 -*-
+# Convert an mbtiles file between the two layouts used here:
+#  -- map/images: tiles deduplicated by content (download.py, build nodes)
+#  -- flat tiles table: one row per tile, no join on read (serving nodes)
+# Tiles are streamed over rowid ranges of the source with set-based SQL, so
+# memory stays bounded by the chunk size whatever the size of the file.
+#  convert.py -i sat.mbtiles -o sat_flat.mbtiles --to tiles
+#  convert.py -i sat_flat.mbtiles -o sat.mbtiles --to map
+#  convert.py -i sat.mbtiles -o sat_clustered.mbtiles --to map --clustered
+
+import sqlite3
+import sys, os
+import argparse
+import time
+from download import MBTiles, tile_layout, rowid_ranges
+
+# GLOBALS
+args = object
+
+def check_flat_schema(c):
+   c.execute('CREATE TABLE IF NOT EXISTS metadata (name text, value text)')
+   c.execute('CREATE TABLE IF NOT EXISTS tiles (zoom_level integer, tile_column integer, tile_row integer, tile_data blob)')
+   c.execute('CREATE UNIQUE INDEX IF NOT EXISTS tile_index ON tiles (zoom_level, tile_column, tile_row)')
+
+def copy_metadata(c):
+   # src is attached to c, metadata names already in the destination are kept
+   if c.execute("SELECT count(*) FROM src.sqlite_master WHERE name = 'metadata'").fetchone()[0] == 0:
+      return 0
+   c.execute("""INSERT INTO metadata (name, value) SELECT name, value FROM src.metadata
+         WHERE name NOT IN (SELECT name FROM metadata)""")
+   return c.rowcount
+
+def to_map(src, dest, chunk=20000, clustered=False):
+   # merge_from hashes each tile and stores every image once
+   db = MBTiles(dest, clustered=clustered)
+   db.CheckSchema()
+   tiles = db.merge_from(src, on_conflict='replace', chunk=chunk)
+   db.c.execute('ATTACH DATABASE ? AS src', (src,))
+   copied = copy_metadata(db.c)
+   db.conn.commit()
+   db.c.execute('DETACH DATABASE src')
+   print('copied %s metadata rows'%copied)
+   return tiles
+
+def to_flat(src, dest, chunk=20000):
+   start = time.time()
+   conn = sqlite3.connect(dest)
+   c = conn.cursor()
+   check_flat_schema(c)
+   conn.commit()
+   c.execute('ATTACH DATABASE ? AS src', (src,))
+   try:
+      if tile_layout(c, 'src') != 'map':
+         raise RuntimeError('%s has no map/images tables'%src)
+      tiles = 0
+      for low, high in rowid_ranges(c, 'src.map', chunk):
+         c.execute("""INSERT OR REPLACE INTO tiles (zoom_level, tile_column, tile_row, tile_data)
+               SELECT m.zoom_level, m.tile_column, m.tile_row, i.tile_data
+               FROM src.map m JOIN src.images i ON i.tile_id = m.tile_id
+               WHERE m.rowid >= ? AND m.rowid < ?""", (low, high))
+         tiles += c.rowcount
+         conn.commit()
+      copied = copy_metadata(c)
+      conn.commit()
+   finally:
+      conn.commit()
+      c.execute('DETACH DATABASE src')
+   elapsed = time.time() - start
+   print('wrote %s tiles and %s metadata rows to %s in %2.1f seconds (%2.1f tiles/s)'%\
+         (tiles,copied,dest,elapsed,tiles/elapsed if elapsed > 0 else 0.0))
+   conn.close()
+   return tiles
+
+def convert(src, dest, layout=None, chunk=20000, clustered=False):
+   # layout is 'map' or 'tiles', default is the one src is not in;
+   # clustered stores a new map in tile_key order (map to map re-clusters)
+   conn = sqlite3.connect(src)
+   have = tile_layout(conn.cursor())
+   conn.close()
+   if have is None:
+      raise RuntimeError('%s has neither map/images nor a tiles table'%src)
+   if layout is None:
+      layout = have == 'map' and 'tiles' or 'map'
+   if layout == 'map':
+      return to_map(src, dest, chunk, clustered)
+   if have != 'map':
+      raise RuntimeError('%s already has a flat tiles table'%src)
+   return to_flat(src, dest, chunk)
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Convert mbtiles between the map/images and flat tiles layouts.")
+    parser.add_argument("-i", "--input", help="Source mbtiles filename.", required=True)
+    parser.add_argument("-o", "--output", help="Destination mbtiles filename.", required=True)
+    parser.add_argument("--to", help="Layout to write (Default: the one the source is not in).", choices=['map','tiles'])
+    parser.add_argument("--chunk", help="Source rows per transaction. (Default=20000)", type=int, default=20000)
+    parser.add_argument("--clustered", help="Store a new map/images file in quadkey (tile_key) order.",action="store_true")
+    return parser.parse_args()
+
+def main():
+   global args
+   args = parse_args()
+   if not os.path.isfile(args.input):
+      print('Source %s not found'%args.input)
+      sys.exit(1)
+   if os.path.abspath(args.input) == os.path.abspath(args.output):
+      print('Source and destination must differ')
+      sys.exit(1)
+   convert(args.input, args.output, args.to, args.chunk, args.clustered)
+   sys.exit(0)
+
+if __name__ == "__main__":
+   main()
@@ -0,0 +1,234 @@
+#!/usr/bin/env python
+# -*- coding: UTF-8 -*-
+# The tiles (z, x, y) covering a polygon or a circle, x and y as in the WMTS
+# request (row 0 at the north edge). Tiles are classified from zoom 0 down:
+# a tile no polygon edge passes through is either wholly inside or wholly
+# outside, so only the tiles along the outline are split further and an
+# inside tile stands for its whole subtree.
+#  cover.py -r central_america -z 13
+#  cover.py --lat 37.46 --lon -122.14 --radius 15 -z 13
+#  cover.py --geojson coast.geojson -z 13
+
+import sys, os
+import argparse
+import json
+import math
+
+# GLOBALS
+args = object
+
+MAX_LAT = 85.0511287798 # web mercator stops here
+EARTH_RADIUS = 6371.0 # km
+
+def project(lon, lat):
+   # degrees to web mercator in world units, 0..1 across and down
+   lat = max(-MAX_LAT, min(MAX_LAT, float(lat)))
+   lat_rad = math.radians(lat)
+   u = (float(lon) + 180.0) / 360.0
+   v = (1.0 - math.log(math.tan(lat_rad) + 1 / math.cos(lat_rad)) / math.pi) / 2.0
+   return (min(max(u, 0.0), 1.0), min(max(v, 0.0), 1.0))
+
+def box(west, south, east, north):
+   return [(west, south), (east, south), (east, north), (west, north), (west, south)]
+
+def circle(lat, lon, radius_km, points=64):
+   # ring of (lon, lat) radius_km from the centre along great circles
+   lat1 = math.radians(lat)
+   lon1 = math.radians(lon)
+   d = radius_km / EARTH_RADIUS
+   ring = []
+   for i in range(points):
+      bearing = 2 * math.pi * i / points
+      lat2 = math.asin(math.sin(lat1) * math.cos(d) + math.cos(lat1) * math.sin(d) * math.cos(bearing))
+      lon2 = lon1 + math.atan2(math.sin(bearing) * math.sin(d) * math.cos(lat1),
+            math.cos(d) - math.sin(lat1) * math.sin(lat2))
+      ring.append((math.degrees(lon2), math.degrees(lat2)))
+   ring.append(ring[0])
+   return ring
+
+def rings_of(geojson):
+   # the rings of a GeoJSON Polygon or MultiPolygon, bare or in a Feature
+   # or FeatureCollection; holes are rings too (even-odd rule)
+   kind = geojson.get('type')
+   if kind == 'FeatureCollection':
+      rings = []
+      for feature in geojson['features']:
+         rings += rings_of(feature)
+      return rings
+   if kind == 'Feature':
+      return rings_of(geojson['geometry'])
+   if kind == 'Polygon':
+      return [list(map(tuple, ring)) for ring in geojson['coordinates']]
+   if kind == 'MultiPolygon':
+      return [list(map(tuple, ring)) for polygon in geojson['coordinates'] for ring in polygon]
+   raise ValueError('no polygon in GeoJSON %s'%kind)
+
+def segment_hits_box(edge, x0, y0, x1, y1):
+   ax, ay, bx, by = edge
+   if max(ax, bx) < x0 or min(ax, bx) > x1 or max(ay, by) < y0 or min(ay, by) > y1:
+      return False
+   # the box corners must not all lie on one side of the segment's line
+   dx = bx - ax
+   dy = by - ay
+   sides = [dx * (cy - ay) - dy * (cx - ax) for cx, cy in ((x0, y0), (x1, y0), (x0, y1), (x1, y1))]
+   return min(sides) <= 0 <= max(sides)
+
+def side(ax, ay, bx, by, px, py):
+   return (bx - ax) * (py - ay) - (by - ay) * (px - ax) > 0
+
+def crossings(edges, ax, ay, bx, by):
+   # how many edges the segment a-b crosses
+   count = 0
+   for cx, cy, dx, dy in edges:
+      if side(cx, cy, dx, dy, ax, ay) != side(cx, cy, dx, dy, bx, by) and \
+            side(ax, ay, bx, by, cx, cy) != side(ax, ay, bx, by, dx, dy):
+         count += 1
+   return count
+
+def point_inside(edges, u, v):
+   inside = False
+   for ax, ay, bx, by in edges:
+      if (ay > v) != (by > v) and u < ax + (v - ay) * (bx - ax) / (by - ay):
+         inside = not inside
+   return inside
+
+class TileCover(object):
+   # full[z]: tiles wholly inside, each standing for all its descendants,
+   # only kept where the parent is not full itself; edge[z]: tiles the
+   # outline passes through, part of the cover at their own zoom.
+   #    tiles = cover(rings, 13)
+   #    tiles.count(13), (13, x, y) in tiles, for x, y in tiles.tiles(13)
+
+   def __init__(self, max_zoom):
+      self.max_zoom = max_zoom
+      self.full = {}
+      self.edge = {}
+
+   def __contains__(self, tile):
+      zoom, x, y = tile
+      if zoom > self.max_zoom:
+         return False
+      if (x, y) in self.edge.get(zoom, ()):
+         return True
+      for z in range(zoom + 1):
+         if (x >> (zoom - z), y >> (zoom - z)) in self.full.get(z, ()):
+            return True
+      return False
+
+   def blocks(self, zoom):
+      # (minX, maxX, minY, maxY) inclusive of the full tiles at zoom
+      for z in range(min(zoom, self.max_zoom) + 1):
+         shift = zoom - z
+         for x, y in self.full.get(z, ()):
+            yield (x << shift, ((x + 1) << shift) - 1, y << shift, ((y + 1) << shift) - 1)
+
+   def tiles(self, zoom):
+      # (x, y) of the cover at zoom, each once
+      if zoom > self.max_zoom:
+         return
+      for minX, maxX, minY, maxY in self.blocks(zoom):
+         for y in range(minY, maxY + 1):
+            for x in range(minX, maxX + 1):
+               yield (x, y)
+      for xy in self.edge.get(zoom, ()):
+         yield xy
+
+   def count(self, zoom):
+      if zoom > self.max_zoom:
+         return 0
+      total = len(self.edge.get(zoom, ()))
+      for minX, maxX, minY, maxY in self.blocks(zoom):
+         total += (maxX - minX + 1) * (maxY - minY + 1)
+      return total
+
+   def bbox(self, zoom):
+      # (minX, maxX, minY, maxY) inclusive around the cover, None if empty
+      boxes = list(self.blocks(zoom)) + [(x, x, y, y) for x, y in self.edge.get(zoom, ())]
+      if not boxes or zoom > self.max_zoom:
+         return None
+      return (min(b[0] for b in boxes), max(b[1] for b in boxes),
+            min(b[2] for b in boxes), max(b[3] for b in boxes))
+
+def cover(rings, max_zoom):
+   # TileCover of polygon rings of (lon, lat) down to max_zoom
+   edges = []
+   for ring in rings:
+      points = [project(lon, lat) for lon, lat in ring]
+      if points[0] != points[-1]:
+         points.append(points[0])
+      for (ax, ay), (bx, by) in zip(points, points[1:]):
+         if (ax, ay) != (bx, by):
+            edges.append((ax, ay, bx, by))
+   result = TileCover(max_zoom)
+   # with each tile goes whether its centre is inside; a child's centre is
+   # inside when the parent's is, unless an odd number of the parent's
+   # edges lie between them, so only the world's centre tests every edge
+   stack = [(0, 0, 0, edges, point_inside(edges, 0.5, 0.5))]
+   while stack:
+      zoom, x, y, near, inside = stack.pop()
+      size = 1.0 / (1 << zoom)
+      x0 = x * size
+      y0 = y * size
+      # the children only need the edges that reach into their parent
+      crossing = [e for e in near if segment_hits_box(e, x0, y0, x0 + size, y0 + size)]
+      if not crossing:
+         if inside:
+            result.full.setdefault(zoom, set()).add((x, y))
+         continue
+      result.edge.setdefault(zoom, set()).add((x, y))
+      if zoom < max_zoom:
+         u = x0 + size / 2
+         v = y0 + size / 2
+         for dx, dy in ((0, 0), (1, 0), (0, 1), (1, 1)):
+            cu = x0 + (dx + 0.5) * size / 2
+            cv = y0 + (dy + 0.5) * size / 2
+            child = inside != (crossings(crossing, u, v, cu, cv) % 2 == 1)
+            stack.append((zoom + 1, x * 2 + dx, y * 2 + dy, crossing, child))
+   return result
+
+def region_cover(region, max_zoom):
+   # a regions.json entry: its "geometry" (GeoJSON) if it has one, else
+   # the west/south/east/north box
+   if region.get('geometry'):
+      return cover(rings_of(region['geometry']), max_zoom)
+   return cover([box(region['west'], region['south'], region['east'], region['north'])], max_zoom)
+
+def geojson_cover(filename, max_zoom):
+   with open(filename, 'r') as fp:
+      return cover(rings_of(json.loads(fp.read())), max_zoom)
+
+def circle_cover(lat, lon, radius_km, max_zoom):
+   return cover([circle(lat, lon, radius_km)], max_zoom)
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Count the tiles covering a region, polygon or circle.")
+    parser.add_argument("-r", "--region", help="Region in ./regions.json.")
+    parser.add_argument("--geojson", help="GeoJSON file with the polygon(s).")
+    parser.add_argument("--lat", help="Latitude degrees of the circle centre.", type=float)
+    parser.add_argument("--lon", help="Longitude degrees of the circle centre.", type=float)
+    parser.add_argument("--radius", help="Circle radius(km).", type=float)
+    parser.add_argument("-z", "--zoom", help="Deepest zoom level. (Default=13)", type=int, default=13)
+    return parser.parse_args()
+
+def main():
+   global args
+   args = parse_args()
+   if args.geojson:
+      tiles = geojson_cover(args.geojson, args.zoom)
+   elif args.radius and args.lat is not None and args.lon is not None:
+      tiles = circle_cover(args.lat, args.lon, args.radius, args.zoom)
+   elif args.region:
+      with open('./regions.json', 'r') as fp:
+         tiles = region_cover(json.loads(fp.read())['regions'][args.region], args.zoom)
+   else:
+      print('Give -r, --geojson or --lat, --lon and --radius')
+      sys.exit(1)
+   print('zoom      cover       bbox')
+   for zoom in range(args.zoom + 1):
+      limits = tiles.bbox(zoom)
+      rectangle = limits and (limits[1] - limits[0] + 1) * (limits[3] - limits[2] + 1) or 0
+      print('%4s %10s %10s'%(zoom,tiles.count(zoom),rectangle))
+   sys.exit(0)
+
+if __name__ == "__main__":
+   main()
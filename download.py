@@ -20,11 +20,23 @@ import urllib3
 import tools
 import subprocess
 import json
+import io
 import math
-import uuid
+import hashlib
 import shutil
-from multiprocessing import Process, Lock
+from multiprocessing import Process, Queue
+try:
+   from queue import Empty, Full, Queue as JobQueue
+except ImportError:
+   from Queue import Empty, Full, Queue as JobQueue
+import threading
 import time
+from collections import OrderedDict, deque
+from array import array
+from readpool import ReadPool
+from tilebitmap import TileBitmap
+from mapstore import store_tiles
+from cover import region_cover, geojson_cover
 
 
 # Download source of satellite imagry
@@ -34,6 +46,9 @@ VERSION = os.environ.get('METADATA_VERSION', '3.3')
 src = object # the open url source
 # tiles smaller than this are probably ocean
 threshold = 2000
+# images released only when neither map nor a blank_tiles entry uses them
+image_unused = """NOT EXISTS (SELECT 1 FROM map WHERE map.tile_id = images.tile_id)
+      AND NOT EXISTS (SELECT 1 FROM blank_tiles WHERE blank_tiles.tile_id = images.tile_id)"""
 
 # GLOBALS
 mbTiles = object
@@ -42,20 +57,374 @@ bounds = {}
 regions = {}
 bbox_zoom_start = 10 
 bbox_limits = {}
+region_tiles = None # cover.TileCover of the region being downloaded
+landmask = None # landmask.LandMask, water/land per tile from the vector tiles
 stdscr = object # cursors object for progress feedback
 config_fn = 'config.json'
 config = {}
 earth_around = 40075 # in KM
 tile_metadata = {}
+tile_writer = object # TileWriterProcess that owns writes during a download
+fetch_engine = object # FetchEngine feeding tile_writer during a download
+# (name, table, columns, unique) -- names match the tilelive map/images schema
+schema_indexes = [
+   ('map_index', 'map', ('zoom_level','tile_column','tile_row'), True),
+   ('images_id', 'images', ('tile_id',), True),
+   ('map_tile_id', 'map', ('tile_id',), False),
+]
+
+# zoom_stats is kept current by triggers on map, so every write path
+# (SetTile, TileWriter, the ATTACH copies, deletes) maintains it. min/max
+# only ever grow; rebuild_stats() tightens them after large deletes.
+stats_triggers = [
+   """CREATE TRIGGER IF NOT EXISTS zoom_stats_insert AFTER INSERT ON map BEGIN
+      INSERT OR IGNORE INTO zoom_stats VALUES (NEW.zoom_level, 0,
+         NEW.tile_column, NEW.tile_column, NEW.tile_row, NEW.tile_row, 0);
+      UPDATE zoom_stats SET tile_count = tile_count + 1,
+         min_column = min(min_column, NEW.tile_column), max_column = max(max_column, NEW.tile_column),
+         min_row = min(min_row, NEW.tile_row), max_row = max(max_row, NEW.tile_row),
+         total_bytes = total_bytes + ifnull((SELECT length(tile_data) FROM images WHERE tile_id = NEW.tile_id), 0)
+         WHERE zoom_level = NEW.zoom_level;
+   END""",
+   """CREATE TRIGGER IF NOT EXISTS zoom_stats_delete AFTER DELETE ON map BEGIN
+      UPDATE zoom_stats SET tile_count = tile_count - 1,
+         total_bytes = total_bytes - ifnull((SELECT length(tile_data) FROM images WHERE tile_id = OLD.tile_id), 0)
+         WHERE zoom_level = OLD.zoom_level;
+      DELETE FROM zoom_stats WHERE zoom_level = OLD.zoom_level AND tile_count <= 0;
+   END""",
+   """CREATE TRIGGER IF NOT EXISTS zoom_stats_update AFTER UPDATE OF tile_id ON map BEGIN
+      UPDATE zoom_stats SET total_bytes = total_bytes
+         - ifnull((SELECT length(tile_data) FROM images WHERE tile_id = OLD.tile_id), 0)
+         + ifnull((SELECT length(tile_data) FROM images WHERE tile_id = NEW.tile_id), 0)
+         WHERE zoom_level = NEW.zoom_level;
+   END""",
+]
+
+def tile_hash(data):
+   # content address of a tile image, used as its tile_id
+   return hashlib.md5(data).hexdigest()
+
+def sql_tile_hash(data):
+   # tile_hash() as registered for SQL, where tile_data may be NULL
+   if data is None:
+      return None
+   return tile_hash(data)
+
+def tile_layout(cursor, schema='main'):
+   # 'map' for the map/images layout, 'tiles' for a flat tiles table
+   sql = "SELECT name, type FROM %s.sqlite_master WHERE name IN ('map','images','tiles')"%schema
+   names = dict((row[0], row[1]) for row in cursor.execute(sql).fetchall())
+   if 'map' in names and 'images' in names:
+      return 'map'
+   if names.get('tiles') == 'table':
+      return 'tiles'
+   return None
+
+def merge_filter(prefix, zooms=None, bbox=None, keyed=False):
+   # extra WHERE terms (and their parameters) for merge_from, keyed adds the
+   # tile_key range of each zoom's bbox for a clustered source
+   if bbox is None:
+      if zooms is None:
+         return '', []
+      zooms = list(zooms)
+      return 'AND %szoom_level IN (%s)'%(prefix, ','.join('?' * len(zooms))), zooms
+   if zooms is None:
+      zooms = range(0, 23)
+   terms = []
+   params = []
+   west, south, east, north = bbox
+   for zoom in zooms:
+      xmin,xmax,ymin,ymax = bbox_tile_limits(west,south,east,north,zoom)
+      # its upper bounds are exclusive, BETWEEN is inclusive
+      xmax -= 1
+      ymax -= 1
+      term = '%szoom_level = ? AND %stile_column BETWEEN ? AND ? AND %stile_row BETWEEN ? AND ?'%\
+            (prefix,prefix,prefix)
+      params += [zoom, xmin, xmax, ymin, ymax]
+      if keyed:
+         term += ' AND %stile_key BETWEEN ? AND ?'%prefix
+         params += [tile_key(zoom, xmin, ymin), tile_key(zoom, xmax, ymax)]
+      terms.append('(%s)'%term)
+   return 'AND (%s)'%' OR '.join(terms), params
+
+def quadkey(zoom, x, y):
+   # Bing style quadkey, each digit picks a quarter of the tile above
+   digits = []
+   for level in range(zoom, 0, -1):
+      mask = 1 << (level - 1)
+      digit = 0
+      if x & mask:
+         digit += 1
+      if y & mask:
+         digit += 2
+      digits.append(str(digit))
+   return ''.join(digits)
+
+def spread_bits(v):
+   # 0b1011 -> 0b1000101, x and y interleave into a morton code
+   v &= 0xffffffff
+   v = (v | (v << 16)) & 0x0000ffff0000ffff
+   v = (v | (v << 8)) & 0x00ff00ff00ff00ff
+   v = (v | (v << 4)) & 0x0f0f0f0f0f0f0f0f
+   v = (v | (v << 2)) & 0x3333333333333333
+   v = (v | (v << 1)) & 0x5555555555555555
+   return v
+
+def tile_key(zoom, x, y):
+   # 64 bit key for clustered maps: zoom in the top bits, then the morton
+   # code of x and y (the quadkey as a number). Tiles of one zoom sort
+   # together and every subtree of a tile is one contiguous key range.
+   return (int(zoom) << 48) | spread_bits(int(x)) | (spread_bits(int(y)) << 1)
+
+def sql_tile_key(prefix='NEW.'):
+   # tile_key() spelled out in SQL (columns of up to 24 bits), for the
+   # triggers below, which run for writers that never call tile_key
+   terms = ['(%szoom_level << 48)'%prefix]
+   for bit in range(24):
+      terms.append('((%stile_column >> %d & 1) << %d)'%(prefix, bit, 2 * bit))
+      terms.append('((%stile_row >> %d & 1) << %d)'%(prefix, bit, 2 * bit + 1))
+   return '(%s)'%' | '.join(terms)
+
+# A clustered map is only in key order if every row has its tile_key; rows
+# inserted with an automatic rowid (aggregate.py, other tools) or moved to
+# another tile are rekeyed here, so load_presence and children find them.
+key_triggers = [
+   """CREATE TRIGGER IF NOT EXISTS map_tile_key_insert AFTER INSERT ON map
+      WHEN NEW.tile_key IS NOT %s BEGIN
+      UPDATE map SET tile_key = %s WHERE tile_key = NEW.tile_key;
+   END"""%(sql_tile_key(), sql_tile_key()),
+   """CREATE TRIGGER IF NOT EXISTS map_tile_key_update AFTER UPDATE OF zoom_level, tile_column, tile_row ON map
+      WHEN NEW.tile_key IS NOT %s BEGIN
+      UPDATE map SET tile_key = %s WHERE tile_key = NEW.tile_key;
+   END"""%(sql_tile_key(), sql_tile_key()),
+]
+
+def subtree_keys(zoom, x, y, depth=1):
+   # first and last key of the descendants of (zoom, x, y) depth levels down
+   low = tile_key(zoom + depth, x << depth, y << depth)
+   return low, low + (1 << (2 * depth)) - 1
+
+MAX_ROWID = (1 << 63) - 1
+
+def rowid_ranges(cursor, table, chunk):
+   # (low, high) bounds for "rowid >= low AND rowid < high" holding chunk rows
+   # each; steps over the rows themselves so sparse rowids (tile_key) work too
+   low = cursor.execute('SELECT min(rowid) FROM %s'%table).fetchone()[0]
+   while low is not None:
+      row = cursor.execute('SELECT rowid FROM %s WHERE rowid >= ? ORDER BY rowid LIMIT 1 OFFSET ?'%table,
+            (low, chunk)).fetchone()
+      if row is None:
+         yield low, MAX_ROWID
+         return
+      yield low, row[0]
+      low = row[0]
+
+def vacuum_into(conn, dest):
+   # compacted copy of conn's file; a plain connection will do, so copying
+   # a file does not need MBTiles (CheckSchema, WAL) to touch it first
+   if sqlite3.sqlite_version_info < (3, 27, 0):
+      raise RuntimeError('VACUUM INTO needs sqlite 3.27, this is %s'%sqlite3.sqlite_version)
+   if os.path.exists(dest):
+      raise RuntimeError('%s already exists'%dest)
+   start = time.time()
+   conn.execute('VACUUM INTO ?', (dest,))
+   print('wrote %s (%s bytes) in %2.1f seconds'%(dest,os.path.getsize(dest),time.time()-start))
+
+def copy_mbtiles(src, dest):
+   # a file copy of src that includes what is still only in its -wal file
+   # (every read-write MBTiles open switches to WAL)
+   conn = sqlite3.connect(src, timeout=30)
+   conn.execute('PRAGMA wal_checkpoint(TRUNCATE)')
+   conn.close()
+   shutil.copyfile(src, dest)
+
+def tile_chunks(cursor, zooms=None, chunk=2000):
+   # lists of (zoom, x, y, tile_data) of a map/images or flat file, chunk
+   # rowids at a time: one walk over the file for all zooms, limited to
+   # zooms when given
+   layout = tile_layout(cursor)
+   if layout == 'map':
+      table = 'map'
+      sql = """SELECT map.zoom_level, map.tile_column, map.tile_row, images.tile_data FROM map
+            JOIN images ON images.tile_id = map.tile_id
+            WHERE map.rowid >= ? AND map.rowid < ?"""
+      column = 'map.zoom_level'
+   elif layout == 'tiles':
+      table = 'tiles'
+      sql = """SELECT zoom_level, tile_column, tile_row, tile_data FROM tiles
+            WHERE rowid >= ? AND rowid < ?"""
+      column = 'zoom_level'
+   else:
+      raise RuntimeError('neither map/images nor a tiles table')
+   if zooms:
+      sql += ' AND %s IN (%s)'%(column, ', '.join(str(int(zoom)) for zoom in zooms))
+   for low, high in rowid_ranges(cursor, table, chunk):
+      yield cursor.execute(sql, (low, high)).fetchall()
+
+def map_is_clustered(cursor, schema='main'):
+   columns = [row[1] for row in cursor.execute('PRAGMA %s.table_info(map)'%schema).fetchall()]
+   return 'tile_key' in columns
+
+class TileCache(object):
+   # LRU of tile blobs keyed by (zoom, x, y) and bounded by their total size.
+   # Only tiles that exist are cached; writers must discard what they change.
+   # The reader threads of a ReadPool share one, so every call takes the lock.
+
+   def __init__(self, max_bytes):
+      self.max_bytes = max_bytes
+      self.tiles = OrderedDict()
+      self.size = 0
+      self.hits = 0
+      self.misses = 0
+      self.evictions = 0
+      self.lock = threading.RLock()
+
+   def get(self, key):
+      with self.lock:
+         data = self.tiles.pop(key, None)
+         if data is None:
+            self.misses += 1
+            return None
+         self.tiles[key] = data # most recently used goes to the end
+         self.hits += 1
+         return data
+
+   def put(self, key, data):
+      if len(data) > self.max_bytes:
+         return
+      with self.lock:
+         self.discard(key)
+         self.tiles[key] = data
+         self.size += len(data)
+         while self.size > self.max_bytes:
+            old_key, old_data = self.tiles.popitem(last=False)
+            self.size -= len(old_data)
+            self.evictions += 1
+
+   def discard(self, key):
+      with self.lock:
+         data = self.tiles.pop(key, None)
+         if data is not None:
+            self.size -= len(data)
+
+   def discard_zoom(self, zoom):
+      with self.lock:
+         for key in [key for key in self.tiles if key[0] == int(zoom)]:
+            self.discard(key)
+
+   def clear(self):
+      with self.lock:
+         self.tiles.clear()
+         self.size = 0
+
+   def stats(self):
+      with self.lock:
+         return { 'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions,
+                  'tiles': len(self.tiles), 'bytes': self.size }
+
+   def report(self):
+      state = self.stats()
+      lookups = state['hits'] + state['misses']
+      ratio = 100.0 * state['hits'] / lookups if lookups else 0.0
+      print('tile cache: %s hits, %s misses (%2.1f%% hit rate), %s evictions, %s tiles in %s of %s bytes'%\
+            (state['hits'],state['misses'],ratio,state['evictions'],state['tiles'],state['bytes'],self.max_bytes))
+
+class TilePresence(object):
+   # Which tiles of one zoom exist inside an inclusive tile bbox: one bit
+   # per cell, plus each tile's size in bytes when loaded with sizes=True.
+
+   def __init__(self, zoom, minX, maxX, minY, maxY, sizes=False):
+      self.zoom = zoom
+      self.minX, self.maxX, self.minY, self.maxY = minX, maxX, minY, maxY
+      self.width = max(maxX - minX + 1, 0)
+      self.height = max(maxY - minY + 1, 0)
+      self.bits = bytearray((self.width * self.height + 7) // 8)
+      self.sizes = None
+      if sizes:
+         self.sizes = array('I', [0]) * (self.width * self.height)
+      self.count = 0
+
+   def index(self, x, y):
+      if x < self.minX or x > self.maxX or y < self.minY or y > self.maxY:
+         return -1
+      return (y - self.minY) * self.width + (x - self.minX)
+
+   def add(self, x, y, size=0):
+      i = self.index(x, y)
+      if i < 0:
+         return
+      if not self.bits[i >> 3] & (1 << (i & 7)):
+         self.count += 1
+      self.bits[i >> 3] |= 1 << (i & 7)
+      if self.sizes is not None:
+         self.sizes[i] = size
+
+   def __contains__(self, xy):
+      i = self.index(xy[0], xy[1])
+      return i >= 0 and bool(self.bits[i >> 3] & (1 << (i & 7)))
+
+   def __len__(self):
+      return self.count
+
+   def size(self, x, y):
+      # 0 for a missing tile
+      i = self.index(x, y)
+      if i < 0 or self.sizes is None:
+         return 0
+      return self.sizes[i]
 
 class MBTiles():
-   def __init__(self, filename):
-      self.conn = sqlite3.connect(filename)
+   def __init__(self, filename, cache_bytes=0, readonly=False, clustered=False):
+      # clustered: a new file stores map in tile_key order (see tile_key)
+      self.filename = filename
+      # optional read cache in front of GetTile
+      self.cache = None
+      if cache_bytes:
+         self.cache = TileCache(cache_bytes)
+      # readonly: GetTile/TileExists use a per-thread mmap'd read-only connection
+      self.pool = None
+      if readonly:
+         self.pool = ReadPool(filename)
+         self.conn = self.pool.connection()
+         self.conn.text_factory = str
+         self.c = self.conn.cursor()
+         self.schemaReady = True # nothing to create or migrate
+         self.clustered = map_is_clustered(self.c)
+         self.blank = None
+         self.blank_sigs = {}
+         if self.has_table('blank_tiles'):
+            self.blank = TileBitmap(self.reader, 'blank_rows')
+            self.load_blank_signatures()
+         return
+      self.conn = sqlite3.connect(filename, timeout=30)
       self.conn.row_factory = sqlite3.Row
       self.conn.text_factory = str
       self.c = self.conn.cursor()
+      # new files free pages incrementally (see compact), this has to be set
+      # before anything, even the WAL switch, is written
+      if self.c.execute('SELECT count(*) FROM sqlite_master').fetchone()[0] == 0:
+         self.c.execute('PRAGMA auto_vacuum = INCREMENTAL')
+      # WAL lets readers keep serving the file while a download writes to it
+      self.c.execute('PRAGMA journal_mode=WAL')
+      self.c.execute('PRAGMA synchronous=NORMAL')
+      self.conn.create_function('tile_hash', 1, sql_tile_hash)
+      self.conn.create_function('tile_key', 3, tile_key)
+      self.clustered = clustered or map_is_clustered(self.c)
+      # blank tiles: a canonical image per zoom; the tiles that show it keep
+      # their map row (pointing at that one image) and are also bits in
+      # blank_rows, a fast lookup of which tiles are blank (see learn_blank)
+      self.blank = None
+      self.blank_sigs = {} # zoom -> (tile_id, data)
       self.schemaReady = False
 
+   def reader(self):
+      # connection for tile lookups, per thread when opened readonly
+      if self.pool is None:
+         return self.conn
+      conn = self.pool.connection()
+      conn.text_factory = str
+      return conn
+
    def __del__(self):
       self.conn.commit()
       self.c.close()
@@ -69,17 +438,40 @@ class MBTiles():
       return out
 
    def GetTile(self, zoomLevel, tileColumn, tileRow):
-      rows = self.c.execute("SELECT tile_data FROM tiles WHERE zoom_level = ? AND tile_column = ? AND tile_row = ?", 
+      if self.cache:
+         key = (int(zoomLevel), int(tileColumn), int(tileRow))
+         data = self.cache.get(key)
+         if data is not None:
+            return data
+      rows = self.reader().execute("SELECT tile_data FROM tiles WHERE zoom_level = ? AND tile_column = ? AND tile_row = ?", 
          (zoomLevel, tileColumn, tileRow))
       rows = list(rows)
       if len(rows) == 0:
-         raise RuntimeError("Tile not found")
+         # files written before blank tiles kept their map rows
+         data = self.blank_tile(zoomLevel, tileColumn, tileRow)
+         if data is None:
+            raise RuntimeError("Tile not found")
+         return data
       row = rows[0]
+      if self.cache:
+         self.cache.put(key, row[0])
       return row[0]
 
+   def invalidate(self, zoomLevel, tileColumn, tileRow):
+      if self.cache:
+         self.cache.discard((int(zoomLevel), int(tileColumn), int(tileRow)))
+
    def CheckSchema(self):     
-      sql = 'CREATE TABLE IF NOT EXISTS map (zoom_level INTEGER,tile_column INTEGER,tile_row INTEGER,tile_id TEXT,grid_id TEXT)'
+      if self.clustered:
+         # tile_key aliases the rowid, so the rows themselves sit in key order
+         sql = 'CREATE TABLE IF NOT EXISTS map (tile_key INTEGER PRIMARY KEY,zoom_level INTEGER,tile_column INTEGER,tile_row INTEGER,tile_id TEXT,grid_id TEXT)'
+      else:
+         sql = 'CREATE TABLE IF NOT EXISTS map (zoom_level INTEGER,tile_column INTEGER,tile_row INTEGER,tile_id TEXT,grid_id TEXT)'
       self.c.execute(sql)
+      self.clustered = map_is_clustered(self.c)
+      if self.clustered:
+         for sql in key_triggers:
+            self.c.execute(sql)
 
       sql = 'CREATE TABLE IF NOT EXISTS images (tile_data blob,tile_id text)'
       self.c.execute(sql)
@@ -87,10 +479,229 @@ class MBTiles():
       sql = 'CREATE TABLE IF NOT EXISTS satdata (zoom_level INTEGER,name text,value text)'
       self.c.execute(sql)
 
+      sql = 'CREATE TABLE IF NOT EXISTS metadata (name text, value text)'
+      self.c.execute(sql)
+
       sql = 'CREATE VIEW IF NOT EXISTS tiles AS SELECT map.zoom_level AS zoom_level, map.tile_column AS tile_column, map.tile_row AS tile_row, images.tile_data AS tile_data FROM map JOIN images ON images.tile_id = map.tile_id'
       self.c.execute(sql)
 
+      self.CheckIndexes()
+
+      have_stats = self.has_table('zoom_stats')
+      sql = 'CREATE TABLE IF NOT EXISTS zoom_stats (zoom_level INTEGER PRIMARY KEY, tile_count INTEGER, min_column INTEGER, max_column INTEGER, min_row INTEGER, max_row INTEGER, total_bytes INTEGER)'
+      self.c.execute(sql)
+      for sql in stats_triggers:
+         self.c.execute(sql)
+
+      sql = 'CREATE TABLE IF NOT EXISTS blank_tiles (zoom_level INTEGER PRIMARY KEY, tile_id TEXT, max_size INTEGER)'
+      self.c.execute(sql)
+
+      # download work queue, see add_jobs
+      sql = """CREATE TABLE IF NOT EXISTS jobs (zoom_level INTEGER, tile_column INTEGER, tile_row INTEGER,
+            state TEXT, attempts INTEGER DEFAULT 0, last_error TEXT, PRIMARY KEY (zoom_level, tile_column, tile_row))"""
+      self.c.execute(sql)
+      sql = 'CREATE INDEX IF NOT EXISTS jobs_state ON jobs (state, zoom_level)'
+      self.c.execute(sql)
+
+      # when each tile was last fetched and the validators the server sent,
+      # for conditional refreshes (see stale_tiles)
+      sql = """CREATE TABLE IF NOT EXISTS tile_fetch (zoom_level INTEGER, tile_column INTEGER, tile_row INTEGER,
+            fetched REAL, etag TEXT, last_modified TEXT, PRIMARY KEY (zoom_level, tile_column, tile_row))"""
+      self.c.execute(sql)
+      self.blank = TileBitmap(self.reader, 'blank_rows')
+      self.blank.create()
+      self.conn.commit()
+      self.load_blank_signatures()
       self.schemaReady = True
+      if not have_stats and self.c.execute('SELECT 1 FROM map LIMIT 1').fetchone():
+         self.rebuild_stats()
+
+   def load_blank_signatures(self):
+      sql = """SELECT blank_tiles.zoom_level, blank_tiles.tile_id, images.tile_data
+            FROM blank_tiles JOIN images ON images.tile_id = blank_tiles.tile_id"""
+      self.blank_sigs = {}
+      for zoom, tile_id, data in self.reader().execute(sql).fetchall():
+         self.blank_sigs[zoom] = (tile_id, data)
+
+   def set_blank(self, zoom, data):
+      # data becomes the canonical blank tile of zoom, tiles with its hash
+      # are marked blank (blank_tiles.max_size is no longer used)
+      if not self.schemaReady:
+         self.CheckSchema()
+      tile_id = tile_hash(data)
+      self.c.execute("INSERT OR IGNORE INTO images (tile_data, tile_id) VALUES (?, ?);", (sqlite3.Binary(data), tile_id))
+      old = self.blank_sigs.get(zoom)
+      self.c.execute('INSERT OR REPLACE INTO blank_tiles (zoom_level, tile_id, max_size) VALUES (?, ?, NULL)',
+            (zoom, tile_id))
+      if old and old[0] != tile_id:
+         self.ReleaseImages([old[0]])
+      self.conn.commit()
+      self.blank_sigs[zoom] = (tile_id, data)
+
+   def is_blank(self, zoom, data, tile_id=None):
+      # only the canonical image itself, a size would also match small land
+      # tiles (recompress.py shrinks some below any threshold)
+      sig = self.blank_sigs.get(zoom)
+      if sig is None:
+         return False
+      return (tile_id or tile_hash(data)) == sig[0]
+
+   def blank_tile(self, zoomLevel, tileColumn, tileRow):
+      # the canonical blob when the tile is marked blank, else None
+      sig = self.blank_sigs.get(int(zoomLevel))
+      if sig is None or (zoomLevel, tileColumn, tileRow) not in self.blank:
+         return None
+      return sig[1]
+
+   def learn_blank(self, zoom, max_size=None, chunk=20000):
+      # Take the most common image of zoom no bigger than max_size (default
+      # threshold) as its blank tile and mark the tiles showing it in
+      # blank_rows. Bits without a map row (files written when blank tiles
+      # were not stored) get their row back. Returns the number marked.
+      if not self.schemaReady:
+         self.CheckSchema()
+      if zoom not in self.blank_sigs:
+         row = self.c.execute("""SELECT map.tile_id, count(*) AS n FROM map JOIN images ON images.tile_id = map.tile_id
+               WHERE map.zoom_level = ? AND length(images.tile_data) <= ? GROUP BY map.tile_id
+               ORDER BY n DESC LIMIT 1""", (zoom, max_size or threshold)).fetchone()
+         if row is None or row[1] < 2:
+            return 0
+         data = self.c.execute('SELECT tile_data FROM images WHERE tile_id = ?', (row[0],)).fetchone()[0]
+         self.set_blank(zoom, bytes(data))
+      start = time.time()
+      tile_id = self.blank_sigs[zoom][0]
+      marked = 0
+      for low, high in rowid_ranges(self.c, 'map', chunk):
+         rows = self.c.execute("""SELECT tile_column, tile_row FROM map WHERE rowid >= ? AND rowid < ?
+               AND zoom_level = ? AND tile_id = ?""", (low, high, zoom, tile_id)).fetchall()
+         for tileColumn, tileRow in rows:
+            if self.blank.add(zoom, tileColumn, tileRow):
+               marked += 1
+         self.blank.flush()
+         self.conn.commit()
+      image = (tile_id, self.blank_sigs[zoom][1])
+      keys = []
+      tileRows = [row[0] for row in self.c.execute('SELECT tile_row FROM blank_rows WHERE zoom_level = ?', (zoom,))]
+      for i, tileRow in enumerate(tileRows):
+         keys += [(zoom, tileColumn, tileRow) for tileColumn in self.blank.columns(zoom, tileRow, 0, (1 << zoom) - 1)]
+         if len(keys) >= chunk or i == len(tileRows) - 1:
+            store_tiles(self.c, dict((key, image) for key in keys), self.map_insert(), self.map_row, update=False)
+            self.conn.commit()
+            keys = []
+      print('zoom %s: %s blank tiles marked, %s in total, in %2.1f seconds'%\
+            (zoom,marked,self.blank.count(zoom),time.time()-start))
+      return marked
+
+   def add_jobs(self, tiles):
+      # queue (zoom, x, y) for download; tiles already queued keep their state
+      if not self.schemaReady:
+         self.CheckSchema()
+      self.c.executemany("INSERT OR IGNORE INTO jobs (zoom_level, tile_column, tile_row, state) VALUES (?, ?, ?, 'pending')",
+            tiles)
+      self.conn.commit()
+      return self.c.rowcount
+
+   def pending_jobs(self, zoom, chunk=1000):
+      # pending jobs of a zoom in key order, a chunk per query; rows the
+      # writer marks done meanwhile do not move the position
+      last = (-1, -1)
+      while True:
+         rows = self.c.execute("""SELECT tile_column, tile_row FROM jobs WHERE zoom_level = ? AND state = 'pending'
+               AND (tile_column, tile_row) > (?, ?) ORDER BY tile_column, tile_row LIMIT ?""",
+               (zoom, last[0], last[1], chunk)).fetchall()
+         if not rows:
+            return
+         for tileColumn, tileRow in rows:
+            yield (zoom, tileColumn, tileRow)
+         last = tuple(rows[-1])
+
+   def retry_jobs(self, zoom, max_attempts=3):
+      self.c.execute("UPDATE jobs SET state = 'pending' WHERE zoom_level = ? AND state = 'failed' AND attempts < ?",
+            (zoom, max_attempts))
+      self.conn.commit()
+      return self.c.rowcount
+
+   def job_counts(self, zoom):
+      rows = self.c.execute('SELECT state, count(*) FROM jobs WHERE zoom_level = ? GROUP BY state', (zoom,))
+      return dict((row[0], row[1]) for row in rows)
+
+   def record_fetch(self, zoomLevel, tileColumn, tileRow, etag=None, last_modified=None, fetched=None):
+      # for tiles stored without a TileWriter, the caller commits
+      self.c.execute('INSERT OR REPLACE INTO tile_fetch VALUES (?, ?, ?, ?, ?, ?)',
+            (zoomLevel, tileColumn, tileRow, fetched or time.time(), etag, last_modified))
+
+   def stale_tiles(self, zoom, before, chunk=1000):
+      # stored tiles of a zoom fetched before the time before (never recorded
+      # counts as oldest), oldest first, as (zoom, x, y, etag, last_modified)
+      # the stale rows are sorted once into a temp table and paged by its
+      # rowid, rather than sorting the zoom again for every page
+      self.c.execute('DROP TABLE IF EXISTS temp.stale_tiles')
+      self.c.execute("""CREATE TEMP TABLE stale_tiles AS SELECT coalesce(f.fetched, 0) AS t,
+            map.tile_column, map.tile_row, f.etag, f.last_modified FROM map LEFT JOIN tile_fetch f
+            ON f.zoom_level = map.zoom_level AND f.tile_column = map.tile_column AND f.tile_row = map.tile_row
+            WHERE map.zoom_level = ? AND t < ? ORDER BY t, map.tile_column, map.tile_row""", (zoom, before))
+      last = 0
+      try:
+         while True:
+            rows = self.c.execute("""SELECT rowid, tile_column, tile_row, etag, last_modified
+                  FROM temp.stale_tiles WHERE rowid > ? ORDER BY rowid LIMIT ?""", (last, chunk)).fetchall()
+            if not rows:
+               return
+            for rowid, tileColumn, tileRow, etag, last_modified in rows:
+               yield (zoom, tileColumn, tileRow, etag, last_modified)
+            last = rows[-1][0]
+      finally:
+         self.c.execute('DROP TABLE IF EXISTS temp.stale_tiles')
+
+   def has_table(self, name):
+      sql = "SELECT count(*) FROM sqlite_master WHERE type = 'table' AND name = ?"
+      return self.c.execute(sql, (name,)).fetchone()[0] > 0
+
+   def rebuild_stats(self):
+      # recompute zoom_stats with one full scan (old files, or after big deletes)
+      if not self.schemaReady:
+         self.CheckSchema()
+      start = time.time()
+      self.c.execute('DELETE FROM zoom_stats')
+      self.c.execute("""INSERT INTO zoom_stats SELECT map.zoom_level, count(*),
+            min(map.tile_column), max(map.tile_column), min(map.tile_row), max(map.tile_row),
+            sum(ifnull(length(images.tile_data), 0))
+            FROM map LEFT JOIN images ON images.tile_id = map.tile_id GROUP BY map.zoom_level""")
+      self.conn.commit()
+      zooms = self.c.execute('SELECT count(*) FROM zoom_stats').fetchone()[0]
+      print('Rebuilt zoom_stats for %s zoom levels in %2.2f seconds'%(zooms,time.time()-start))
+
+   def FindIndex(self, table, columns, unique=True):
+      # return the name of an index on exactly these columns, whatever it is called
+      for index in self.c.execute('PRAGMA index_list(%s)'%table).fetchall():
+         if unique and not index['unique']:
+            continue
+         info = self.conn.execute('PRAGMA index_info(%s)'%index['name']).fetchall()
+         if tuple(row['name'] for row in info) == columns:
+            return index['name']
+      return None
+
+   def CheckIndexes(self):
+      # older files were created without indexes -- migrate them in place
+      for name, table, columns, unique in schema_indexes:
+         if self.FindIndex(table, columns, unique):
+            continue
+         start = time.time()
+         column_list = ','.join(columns)
+         removed = 0
+         if unique:
+            # a unique index cannot be built over duplicates, keep the newest row
+            sql = 'DELETE FROM %s WHERE rowid NOT IN (SELECT max(rowid) FROM %s GROUP BY %s)'%(table,table,column_list)
+            self.c.execute(sql)
+            removed = self.c.rowcount
+            sql = 'CREATE UNIQUE INDEX IF NOT EXISTS %s ON %s (%s)'%(name,table,column_list)
+         else:
+            sql = 'CREATE INDEX IF NOT EXISTS %s ON %s (%s)'%(name,table,column_list)
+         self.c.execute(sql)
+         self.conn.commit()
+         rows = self.c.execute('SELECT count(*) FROM %s'%table).fetchone()[0]
+         print('Created index %s on %s(%s): %s rows indexed, %s duplicates removed in %2.2f seconds'%\
+               (name,table,column_list,rows,removed,time.time()-start))
 
    def GetAllMetaData(self):
       rows = self.c.execute("SELECT name, value FROM metadata")
@@ -148,44 +759,117 @@ class MBTiles():
       if not self.schemaReady:
          self.CheckSchema()
 
-      tile_id = self.TileExists(zoomLevel, tileColumn, tileRow)
-      if tile_id: 
-         tile_id = uuid.uuid4().hex
-         operation = 'update images'
-         self.c.execute("DELETE FROM images  WHERE tile_id = ?;", ([tile_id]))
-         self.c.execute("INSERT INTO images (tile_data,tile_id) VALUES ( ?, ?);", (sqlite3.Binary(data),tile_id))
-         if self.c.rowcount != 1:
-            raise RuntimeError("Failure %s RowCount:%s"%(operation,self.c.rowcount))
+      self.invalidate(zoomLevel, tileColumn, tileRow)
+      # images are content addressed, so identical tiles share one row
+      tile_id = tile_hash(data)
+      old_id = self.TileExists(zoomLevel, tileColumn, tileRow)
+      # a blank tile is stored like any other, the bitmap only marks it
+      if self.is_blank(zoomLevel, data, tile_id):
+         if self.blank.add(zoomLevel, tileColumn, tileRow):
+            self.blank.flush()
+      elif zoomLevel in self.blank_sigs and self.blank.discard(zoomLevel, tileColumn, tileRow):
+         self.blank.flush()
+      if old_id == tile_id:
+         self.conn.commit()
+         return
+      self.c.execute("INSERT OR IGNORE INTO images (tile_data,tile_id) VALUES ( ?, ?);", (sqlite3.Binary(data),tile_id))
+      self.MapTile(zoomLevel, tileColumn, tileRow, tile_id, old_id)
+      self.conn.commit()
+   
+   def MapTile(self, zoomLevel, tileColumn, tileRow, tile_id, old_id):
+      # point map at a stored image and let go of the one it replaces
+      if old_id: 
+         operation = 'update map'
          self.c.execute("""UPDATE map SET tile_id=? where zoom_level = ? AND 
                tile_column = ? AND tile_row = ?;""", 
             (tile_id, zoomLevel, tileColumn, tileRow))
-         if self.c.rowcount != 1:
-            raise RuntimeError("Failure %s RowCount:%s"%(operation,self.c.rowcount))
-         self.conn.commit()
-         return
       else: # this is not an update
-         tile_id = uuid.uuid4().hex
-         self.c.execute("INSERT INTO images ( tile_data,tile_id) VALUES ( ?, ?);", (sqlite3.Binary(data),tile_id))
-         if self.c.rowcount != 1:
-            raise RuntimeError("Insert image failure")
          operation = 'insert into map'
-         self.c.execute("INSERT INTO map (zoom_level, tile_column, tile_row, tile_id) VALUES (?, ?, ?, ?);", 
-            (zoomLevel, tileColumn, tileRow, tile_id))
+         self.c.execute("INSERT INTO map (%s) VALUES (%s);"%self.map_insert(), 
+            self.map_row(zoomLevel, tileColumn, tileRow, tile_id))
       if self.c.rowcount != 1:
          raise RuntimeError("Failure %s RowCount:%s"%(operation,self.c.rowcount))
-      self.conn.commit()
-   
+      if old_id:
+         self.ReleaseImages([old_id])
+
+   def map_insert(self):
+      # (columns, placeholders) for inserts into map, see map_row
+      if self.clustered:
+         return 'tile_key, zoom_level, tile_column, tile_row, tile_id', '?, ?, ?, ?, ?'
+      return 'zoom_level, tile_column, tile_row, tile_id', '?, ?, ?, ?'
+
+   def map_row(self, zoomLevel, tileColumn, tileRow, tile_id):
+      if self.clustered:
+         return (tile_key(zoomLevel, tileColumn, tileRow), zoomLevel, tileColumn, tileRow, tile_id)
+      return (zoomLevel, tileColumn, tileRow, tile_id)
+
+   def load_presence(self, zoom, bbox, sizes=False):
+      # one range query over map_index instead of a TileExists per cell;
+      # bbox is (minX, maxX, minY, maxY), inclusive
+      minX, maxX, minY, maxY = bbox
+      presence = TilePresence(zoom, minX, maxX, minY, maxY, sizes)
+      params = [zoom, minX, maxX, minY, maxY]
+      where = ''
+      if self.clustered:
+         # the bbox lies between the keys of its corners, one range scan of map
+         where = 'AND map.tile_key BETWEEN ? AND ?'
+         params += [tile_key(zoom, minX, minY), tile_key(zoom, maxX, maxY)]
+      if sizes:
+         sql = """SELECT map.tile_column, map.tile_row, length(images.tile_data) FROM map
+               JOIN images ON images.tile_id = map.tile_id WHERE map.zoom_level = ? AND
+               map.tile_column BETWEEN ? AND ? AND map.tile_row BETWEEN ? AND ? %s"""%where
+      else:
+         sql = """SELECT map.tile_column, map.tile_row, 0 FROM map WHERE map.zoom_level = ? AND
+               map.tile_column BETWEEN ? AND ? AND map.tile_row BETWEEN ? AND ? %s"""%where
+      for tileColumn, tileRow, size in self.reader().execute(sql, params):
+         presence.add(tileColumn, tileRow, size or 0)
+      sig = self.blank_sigs.get(zoom)
+      if sig is not None:
+         # blank tiles have map rows, this covers files from before they did
+         for tileRow in range(minY, maxY + 1):
+            for tileColumn in self.blank.columns(zoom, tileRow, minX, maxX):
+               presence.add(tileColumn, tileRow, len(sig[1]))
+      return presence
+
+   def children(self, zoomLevel, tileColumn, tileRow, depth=1):
+      # (zoom, x, y) of the stored descendants depth levels below a tile
+      zoom = zoomLevel + depth
+      if self.clustered:
+         low, high = subtree_keys(zoomLevel, tileColumn, tileRow, depth)
+         sql = 'SELECT zoom_level, tile_column, tile_row FROM map WHERE tile_key BETWEEN ? AND ?'
+         params = (low, high)
+      else:
+         sql = """SELECT zoom_level, tile_column, tile_row FROM map WHERE zoom_level = ? AND
+               tile_column BETWEEN ? AND ? AND tile_row BETWEEN ? AND ?"""
+         params = (zoom, tileColumn << depth, ((tileColumn + 1) << depth) - 1,
+               tileRow << depth, ((tileRow + 1) << depth) - 1)
+      return [tuple(row) for row in self.reader().execute(sql, params).fetchall()]
+
+   def ReleaseImages(self, tile_ids):
+      # drop images that no map row refers to any longer
+      self.c.executemany("DELETE FROM images WHERE tile_id = ? AND %s;"%image_unused,
+         [(tile_id,) for tile_id in tile_ids])
 
    def DeleteTile(self, zoomLevel, tileColumn, tileRow):
       if not self.schemaReady:
          self.CheckSchema()
 
+      self.invalidate(zoomLevel, tileColumn, tileRow)
       tile_id = self.TileExists(zoomLevel, tileColumn, tileRow)
       if not tile_id:
+         if self.blank.discard(zoomLevel, tileColumn, tileRow):
+            self.blank.flush()
+            self.conn.commit()
+            return
          raise RuntimeError("Tile not found")
 
-      self.c.execute("DELETE FROM images WHERE tile_id = ?;",tile_id) 
-      self.c.execute("DELETE FROM map WHERE tile_id = ?;",tile_id) 
+      self.c.execute("DELETE FROM map WHERE zoom_level = ? AND tile_column = ? AND tile_row = ?;",
+         (zoomLevel, tileColumn, tileRow)) 
+      if self.blank.discard(zoomLevel, tileColumn, tileRow):
+         self.blank.flush()
+      self.c.execute("DELETE FROM tile_fetch WHERE zoom_level = ? AND tile_column = ? AND tile_row = ?;",
+         (zoomLevel, tileColumn, tileRow))
+      self.ReleaseImages([tile_id])
       self.conn.commit()
 
    def TileExists(self, zoomLevel, tileColumn, tileRow):
@@ -193,48 +877,142 @@ class MBTiles():
          self.CheckSchema()
 
       sql = 'select tile_id from map where zoom_level = ? and tile_column = ? and tile_row = ?'
-      self.c.execute(sql,(zoomLevel, tileColumn, tileRow))
-      row = self.c.fetchall()
+      row = self.reader().execute(sql,(zoomLevel, tileColumn, tileRow)).fetchall()
       if len(row) == 0:
          return None
       return str(row[0][0])
 
-   def DownloadTile(self, zoomLevel, tileColumn, tileRow, lock):
-      # if the tile already exists, do nothing
-      lock.acquire()
-      tile_id = self.TileExists(zoomLevel, tileColumn, tileRow)
-      lock.release()
-      if tile_id:
-         #print('tile already exists -- skipping')
-         return 
-      try:
-         #wmts_row = int(2 ** zoomLevel - tileRow - 1)
-         r = src.get(zoomLevel,tileColumn,tileRow)
-      except Exception as e:
-         raise RuntimeError("Source data failure;%s"%e)
-         
-      if r.status == 200:
-         lock.acquire()
-         self.SetTile(zoomLevel, tileColumn, tileRow, r.data)
+   def Commit(self):
+      self.conn.commit()
+
+   def dedup_images(self, chunk=1000):
+      # One-shot pass for files written before images were content addressed:
+      # rekey every image by its hash and merge the duplicates.
+      if not self.schemaReady:
+         self.CheckSchema()
+      start = time.time()
+      last = merged = rekeyed = reclaimed = 0
+      while True:
+         rows = self.c.execute('SELECT rowid, tile_id, tile_data FROM images WHERE rowid > ? ORDER BY rowid LIMIT ?',
+               (last, chunk)).fetchall()
+         if not rows:
+            break
+         for row in rows:
+            last = row[0]
+            tile_id = tile_hash(row['tile_data'])
+            if tile_id == row['tile_id']:
+               continue
+            self.c.execute("INSERT OR IGNORE INTO images (tile_data, tile_id) VALUES (?, ?);",
+               (row['tile_data'], tile_id))
+            if self.c.rowcount == 0: # an identical image is already stored
+               merged += 1
+               reclaimed += len(row['tile_data'])
+            else:
+               rekeyed += 1
+            self.c.execute("UPDATE map SET tile_id = ? WHERE tile_id = ?;", (tile_id, row['tile_id']))
+            self.c.execute("DELETE FROM images WHERE rowid = ?;", (row[0],))
          self.conn.commit()
-         lock.release()
-      else:
-         print('Sat data error, returned:%s'%r.status)
+      print('dedup: %s images rekeyed, %s duplicates merged, %s bytes (%2.1f MB) reclaimed in %2.1f seconds'%\
+            (rekeyed,merged,reclaimed,reclaimed/1000000.0,time.time()-start))
+      return reclaimed
+
+   def collect_garbage(self, chunk=1000, pause=0.05):
+      # Remove images no map row refers to (left behind by older SetTile
+      # updates). Works in short rowid-ordered transactions, sleeping between
+      # them, so a reader serving this file is never blocked for long.
+      if not self.schemaReady:
+         self.CheckSchema()
+      start = time.time()
+      last = orphans = removed_bytes = 0
+      while True:
+         rows = self.c.execute("""SELECT rowid, length(tile_data) AS size, NOT (%s) AS used
+               FROM images WHERE rowid > ? ORDER BY rowid LIMIT ?"""%image_unused, (last, chunk)).fetchall()
+         if not rows:
+            break
+         last = rows[-1][0]
+         for row in rows:
+            if row['used']:
+               continue
+            # check again, a writer may have reused the image since the scan
+            self.c.execute("DELETE FROM images WHERE rowid = ? AND %s;"%image_unused, (row[0],))
+            if self.c.rowcount == 1:
+               orphans += 1
+               removed_bytes += row['size'] or 0
+         self.conn.commit()
+         if pause:
+            time.sleep(pause)
+      print('gc: removed %s orphaned images, %s bytes (%2.1f MB) in %2.1f seconds'%\
+            (orphans,removed_bytes,removed_bytes/1000000.0,time.time()-start))
+      self.compact()
+      return orphans, removed_bytes
+
+   def compact(self, max_pages=None, time_budget=None, pages_per_step=1000):
+      # Hand free pages back to the filesystem in small incremental_vacuum
+      # steps, stopping after max_pages or time_budget seconds, instead of
+      # rewriting the whole file with VACUUM.
+      start = time.time()
+      free = self.c.execute('PRAGMA freelist_count').fetchone()[0]
+      if self.c.execute('PRAGMA auto_vacuum').fetchone()[0] != 2:
+         print('%s free pages will be reused by new tiles (auto_vacuum is not INCREMENTAL, see --incremental)'%free)
+         return 0
+      released = 0
+      while free > 0:
+         if max_pages is not None and released >= max_pages:
+            break
+         if time_budget is not None and time.time() - start >= time_budget:
+            break
+         step = pages_per_step
+         if max_pages is not None:
+            step = min(step, max_pages - released)
+         self.c.execute('PRAGMA incremental_vacuum(%d)'%step).fetchall()
+         self.conn.commit()
+         left = self.c.execute('PRAGMA freelist_count').fetchone()[0]
+         released += free - left
+         if left >= free:
+            break
+         free = left
+      print('compact: released %s free pages, %s left, in %2.1f seconds'%(released,free,time.time()-start))
+      return released
+
+   def enable_incremental_vacuum(self):
+      # one full VACUUM to switch an older file to auto_vacuum=INCREMENTAL
+      start = time.time()
+      self.conn.commit()
+      self.c.execute('PRAGMA auto_vacuum = INCREMENTAL')
+      self.c.execute('VACUUM')
+      print('auto_vacuum is now %s (took %2.1f seconds)'%\
+            (self.c.execute('PRAGMA auto_vacuum').fetchone()[0],time.time()-start))
 
-   def Commit(self):
+   def vacuum_into(self, dest):
+      # compacted copy for distribution, the live file is left as it is
       self.conn.commit()
+      vacuum_into(self.conn, dest)
+
+   def writer(self, batch_size=500, commit_interval=5.0):
+      return TileWriter(self, batch_size, commit_interval)
+
+   def set_tiles(self, tiles, batch_size=500, commit_interval=5.0):
+      # tiles is any iterable of (zoomLevel, tileColumn, tileRow, data)
+      with self.writer(batch_size, commit_interval) as writer:
+         for zoomLevel, tileColumn, tileRow, data in tiles:
+            writer.add(zoomLevel, tileColumn, tileRow, data)
+      return writer.written
 
    def get_bounds(self):
      global bounds
-     sql = 'select zoom_level, min(tile_column),max(tile_column),min(tile_row),max(tile_row), count(zoom_level) from tiles group by zoom_level;'
+     if not self.schemaReady:
+        self.CheckSchema()
+     sql = 'select zoom_level, min_column, max_column, min_row, max_row, tile_count from zoom_stats order by zoom_level;'
+     if not self.has_table('zoom_stats'): # an old file opened readonly
+        sql = 'select zoom_level, min(tile_column) as min_column, max(tile_column) as max_column, min(tile_row) as min_row, max(tile_row) as max_row, count(*) as tile_count from map group by zoom_level;'
      resp = self.c.execute(sql)
      rows = resp.fetchall()
      for row in rows:
-         bounds[row['zoom_level']] = { 'minX': row['min(tile_column)'],\
-                                  'maxX': row['max(tile_column)'],\
-                                  'minY': row['min(tile_row)'],\
-                                  'maxY': row['max(tile_row)'],\
-                                  'count': row['count(zoom_level)'],\
+         bounds[row['zoom_level']] = { 'minX': row['min_column'],\
+                                  'maxX': row['max_column'],\
+                                  'minY': row['min_row'],\
+                                  'maxY': row['max_row'],\
+                                  'count': row['tile_count'],\
                                  }
      outstr = json.dumps(bounds,indent=2)
      # diagnostic info
@@ -243,14 +1021,16 @@ class MBTiles():
      return bounds
 
    def summarize(self):
-     sql = 'select zoom_level, min(tile_column),max(tile_column),min(tile_row),max(tile_row), count(zoom_level) from tiles group by zoom_level;'
+     if not self.schemaReady:
+        self.CheckSchema()
+     sql = 'select zoom_level, min_column, max_column, min_row, max_row, tile_count, total_bytes from zoom_stats order by zoom_level;'
      self.c.execute(sql)
      rows = self.c.fetchall()
      print('Zoom Levels Found:%s'%len(rows))
      for row in rows:
        if row[2] != None and row[1] != None and row[3] != None and row[4] != None:
-         print('%s %s %s %s %s %s %s'%(row[0],row[1],row[2],row[3],row[4],\
-              row[5], (row[2]-row[1]+1) * ( row[4]-row[3]+1)))
+         print('%s %s %s %s %s %s %s %s'%(row[0],row[1],row[2],row[3],row[4],\
+              row[5], (row[2]-row[1]+1) * ( row[4]-row[3]+1), row[6]))
          self.SetSatMetaData(row[0],'minX',row[1])
          self.SetSatMetaData(row[0],'maxX',row[2])
          self.SetSatMetaData(row[0],'minY',row[3])
@@ -260,60 +1040,853 @@ class MBTiles():
          
   
    def CountTiles(self,zoom):
-      self.c.execute("select tile_data from tiles where zoom_level = ?",(zoom,))
-      num = 0
-      while self.c.fetchone():
-         num += 1 
-      return num
+      if not self.schemaReady:
+         self.CheckSchema()
+      row = self.c.execute("select tile_count from zoom_stats where zoom_level = ?",(zoom,)).fetchone()
+      if row is None:
+         return 0
+      return row[0]
 
    def execute_script(self,script):
       self.c.executescript(script)
 
    def copy_zoom(self,zoom,src):
-      sql = 'ATTACH DATABASE "%s" as src'%src
-      self.c.execute(sql)
-      sql = 'INSERT INTO map SELECT * from src.map where src.map.zoom_level=?'
-      self.c.execute(sql,[zoom])
-      sql = 'INSERT OR IGNORE INTO images SELECT src.images.tile_data, src.images.tile_id from src.images JOIN src.map ON src.map.tile_id = src.images.tile_id where map.zoom_level=?'
-      self.c.execute(sql,[zoom])
-      sql = 'DETACH DATABASE src'
-      self.c.execute(sql)
+      return self.merge_from(src, zooms=[int(zoom)])
 
    def copy_mbtile(self,src):
-      sql = 'ATTACH DATABASE "%s" as src'%src
-      self.c.execute(sql)
-      sql = 'INSERT INTO map SELECT * from src.map where true'
-      self.c.execute(sql,[zoom])
-      sql = 'INSERT OR IGNORE INTO images SELECT src.images.tile_data, src.images.tile_id from src.images JOIN src.map ON src.map.tile_id = src.images.tile_id where true'
-      self.c.execute(sql,[zoom])
-      sql = 'DETACH DATABASE src'
-      self.c.execute(sql)
+      return self.merge_from(src)
+
+   def merge_from(self, src, zooms=None, bbox=None, on_conflict='skip', chunk=20000):
+      # Copy tiles from another MBTiles file, map/images or flat tiles layout,
+      # with set-based SQL over rowid ranges of the source.
+      #   zooms: iterable of zoom levels (default all)
+      #   bbox: (west, south, east, north) degrees, needs zooms or uses 0-22
+      #   on_conflict: skip keeps our tile, replace takes theirs, newer takes
+      #      theirs when it was fetched later (tile_fetch), or when the source
+      #      file was modified after this one if it keeps no fetch times
+      if on_conflict not in ('skip', 'replace', 'newer'):
+         raise ValueError('on_conflict must be skip, replace or newer')
+      if not self.schemaReady:
+         self.CheckSchema()
+      start = time.time()
+      self.conn.commit()
+      self.c.execute('ATTACH DATABASE ? AS src', (src,))
+      try:
+         layout = tile_layout(self.c, 'src')
+         if layout == 'map':
+            source = 'src.map m JOIN src.images i ON i.tile_id = m.tile_id'
+            columns = 'm.zoom_level, m.tile_column, m.tile_row, tile_hash(i.tile_data), i.rowid'
+            key, key_table, prefix = 'm.rowid', 'src.map', 'm.'
+         elif layout == 'tiles':
+            source = 'src.tiles t'
+            columns = 't.zoom_level, t.tile_column, t.tile_row, tile_hash(t.tile_data), t.rowid'
+            key, key_table, prefix = 't.rowid', 'src.tiles', 't.'
+         else:
+            raise RuntimeError('%s has neither map/images nor a tiles table'%src)
+         image_source = layout == 'map' and 'src.images' or 'src.tiles'
+         src_fetch = self.c.execute("""SELECT count(*) FROM src.sqlite_master
+               WHERE type = 'table' AND name = 'tile_fetch'""").fetchone()[0] > 0
+         if on_conflict == 'newer' and not src_fetch:
+            if os.path.getmtime(src) > os.path.getmtime(self.filename):
+               on_conflict = 'replace'
+            else:
+               on_conflict = 'skip'
+
+         keyed = layout == 'map' and map_is_clustered(self.c, 'src')
+         where, params = merge_filter(prefix, zooms, bbox, keyed)
+         self.c.execute("""CREATE TEMP TABLE IF NOT EXISTS merge_chunk (zoom_level INTEGER,
+               tile_column INTEGER, tile_row INTEGER, tile_id TEXT, src_rowid INTEGER,
+               PRIMARY KEY (zoom_level, tile_column, tile_row))""")
+         self.c.execute('CREATE TEMP TABLE IF NOT EXISTS merge_old (tile_id TEXT)')
+         if self.clustered:
+            map_insert = """INSERT OR IGNORE INTO map (tile_key, zoom_level, tile_column, tile_row, tile_id)
+                  SELECT tile_key(zoom_level, tile_column, tile_row), zoom_level, tile_column, tile_row,
+                  tile_id FROM temp.merge_chunk ORDER BY 1"""
+         else:
+            map_insert = """INSERT OR IGNORE INTO map (zoom_level, tile_column, tile_row, tile_id)
+                  SELECT zoom_level, tile_column, tile_row, tile_id FROM temp.merge_chunk"""
+         merged = 0
+         for low, high in rowid_ranges(self.c, key_table, chunk):
+            self.c.execute('DELETE FROM temp.merge_chunk')
+            self.c.execute('DELETE FROM temp.merge_old')
+            sql = """INSERT OR REPLACE INTO temp.merge_chunk SELECT %s FROM %s
+                  WHERE %s >= ? AND %s < ? %s"""%(columns, source, key, key, where)
+            self.c.execute(sql, [low, high] + params)
+            if on_conflict == 'skip':
+               self.c.execute("""DELETE FROM temp.merge_chunk WHERE rowid IN (SELECT c.rowid
+                     FROM temp.merge_chunk c JOIN map USING (zoom_level, tile_column, tile_row))""")
+            else:
+               self.c.execute("""DELETE FROM temp.merge_chunk WHERE rowid IN (SELECT c.rowid
+                     FROM temp.merge_chunk c JOIN map USING (zoom_level, tile_column, tile_row)
+                     WHERE map.tile_id = c.tile_id)""")
+            if on_conflict == 'newer':
+               # never fetched counts as oldest, a tie keeps ours
+               self.c.execute("""DELETE FROM temp.merge_chunk WHERE rowid IN (SELECT c.rowid
+                     FROM temp.merge_chunk c JOIN map USING (zoom_level, tile_column, tile_row)
+                     LEFT JOIN tile_fetch f ON f.zoom_level = c.zoom_level AND f.tile_column = c.tile_column
+                     AND f.tile_row = c.tile_row LEFT JOIN src.tile_fetch s ON s.zoom_level = c.zoom_level
+                     AND s.tile_column = c.tile_column AND s.tile_row = c.tile_row
+                     WHERE coalesce(s.fetched, 0) <= coalesce(f.fetched, 0))""")
+            self.c.execute("""INSERT OR IGNORE INTO images (tile_data, tile_id)
+                  SELECT s.tile_data, c.tile_id FROM temp.merge_chunk c
+                  JOIN %s s ON s.rowid = c.src_rowid"""%image_source)
+            if on_conflict in ('replace', 'newer'):
+               self.c.execute("""INSERT INTO temp.merge_old SELECT map.tile_id FROM temp.merge_chunk c
+                     JOIN map USING (zoom_level, tile_column, tile_row)""")
+               self.c.execute("""UPDATE map SET tile_id = (SELECT c.tile_id FROM temp.merge_chunk c
+                     WHERE c.zoom_level = map.zoom_level AND c.tile_column = map.tile_column
+                     AND c.tile_row = map.tile_row) WHERE rowid IN (SELECT map.rowid
+                     FROM temp.merge_chunk c JOIN map USING (zoom_level, tile_column, tile_row))""")
+            self.c.execute(map_insert)
+            if src_fetch:
+               self.c.execute("""INSERT OR REPLACE INTO tile_fetch SELECT s.* FROM temp.merge_chunk c
+                     JOIN src.tile_fetch s USING (zoom_level, tile_column, tile_row)""")
+            merged += self.c.execute('SELECT count(*) FROM temp.merge_chunk').fetchone()[0]
+            if self.blank_sigs:
+               # merged tiles showing our blank image are marked, replaced ones unmarked
+               for zoomLevel, tileColumn, tileRow, tile_id in self.c.execute("""SELECT zoom_level,
+                     tile_column, tile_row, tile_id FROM temp.merge_chunk""").fetchall():
+                  sig = self.blank_sigs.get(zoomLevel)
+                  if sig is not None:
+                     self.blank.change(zoomLevel, tileColumn, tileRow, tile_id == sig[0])
+               self.blank.flush()
+            self.c.execute("""DELETE FROM images WHERE tile_id IN (SELECT tile_id FROM temp.merge_old)
+                  AND %s"""%image_unused)
+            self.conn.commit()
+      finally:
+         self.conn.commit()
+         self.c.execute('DETACH DATABASE src')
+      if self.cache and on_conflict != 'skip':
+         self.cache.clear()
+      elapsed = time.time() - start
+      print('merged %s tiles from %s in %2.1f seconds (%2.1f rows/s)'%\
+            (merged,src,elapsed,merged/elapsed if elapsed > 0 else 0.0))
+      return merged
 
    def delete_zoom(self,zoom):
-      sql = 'DELETE FROM images where tile_id in (SELECT tile_id from map WHERE map.zoom_level=?)'
-      self.c.execute(sql,[zoom])
+      if not self.schemaReady:
+         self.CheckSchema()
+      if self.cache:
+         self.cache.discard_zoom(zoom)
+      self.blank.clear_zoom(zoom)
+      self.c.execute('DELETE FROM jobs WHERE zoom_level = ?', (zoom,))
+      self.c.execute('DELETE FROM tile_fetch WHERE zoom_level = ?', (zoom,))
+      self.c.execute('DELETE FROM blank_tiles WHERE zoom_level = ?', (zoom,))
+      sig = self.blank_sigs.pop(int(zoom), None)
+      # images are shared between tiles, keep the ones other zooms still use
+      sql = """DELETE FROM images where tile_id in (SELECT tile_id from map WHERE map.zoom_level=?)
+            AND NOT EXISTS (SELECT 1 FROM map WHERE map.tile_id = images.tile_id AND map.zoom_level != ?)
+            AND NOT EXISTS (SELECT 1 FROM blank_tiles WHERE blank_tiles.tile_id = images.tile_id)"""
+      self.c.execute(sql,[zoom,zoom])
       sql = 'DELETE FROM map where zoom_level=?'
       self.c.execute(sql,[zoom])
-      sql = "vacuum"
-      self.c.execute(sql)
+      if sig:
+         self.ReleaseImages([sig[0]])
+      # freed pages are reused by later writes, compact() hands them back
       self.Commit()
 
-class WMTS(object):
+class TileWriter(object):
+   # Buffers tiles and writes them with executemany inside one transaction,
+   # committing every batch_size tiles or commit_interval seconds rather than
+   # paying a commit (and fsync) for every SetTile.
+   #    with mbTiles.writer() as writer:
+   #       writer.add(zoom, x, y, data)
+
+   def __init__(self, mbtiles, batch_size=500, commit_interval=5.0):
+      self.db = mbtiles
+      self.batch_size = batch_size
+      self.commit_interval = commit_interval
+      self.pending = []
+      self.failures = [] # (error, zoom, x, y) of jobs that could not be fetched
+      self.unchanged = [] # (zoom, x, y) the server answered 304 Not Modified for
+      self.written = 0
+      self.blanks = 0
+      self.commits = 0
+      self.start = time.time()
+      self.last_commit = self.start
+
+   def __enter__(self):
+      return self
+
+   def __exit__(self, exc_type, exc_value, traceback):
+      if exc_type is not None and issubclass(exc_type, sqlite3.Error):
+         self.db.conn.rollback()
+         self.pending = []
+      else:
+         self.flush()
+      self.report()
+      return False
 
-   def __init__(self, template):
+   def add(self, zoomLevel, tileColumn, tileRow, data, fetched=None, etag=None, last_modified=None):
+      # data None marks the tile blank without storing anything;
+      # fetched: time the tile came from the server, recorded in tile_fetch
+      # with the validators (etag, last_modified) it came with
+      self.pending.append((zoomLevel, tileColumn, tileRow, data, fetched, etag, last_modified))
+      if len(self.pending) >= self.batch_size or \
+            time.time() - self.last_commit >= self.commit_interval:
+         self.flush()
+
+   def fail(self, zoomLevel, tileColumn, tileRow, error):
+      self.failures.append((str(error), zoomLevel, tileColumn, tileRow))
+
+   def touch(self, zoomLevel, tileColumn, tileRow):
+      # the stored tile is still current, only its fetch time moves
+      self.unchanged.append((zoomLevel, tileColumn, tileRow))
+      if len(self.unchanged) >= self.batch_size:
+         self.flush()
+
+   def flush(self):
+      self.last_commit = time.time()
+      if not self.pending and not self.failures and not self.unchanged:
+         return
+      db = self.db
+      if not db.schemaReady:
+         db.CheckSchema()
+      # the last write of a tile within a batch wins
+      latest = {}
+      fetches = {}
+      for zoomLevel, tileColumn, tileRow, data, fetched, etag, last_modified in self.pending:
+         latest[(zoomLevel, tileColumn, tileRow)] = data
+         if fetched:
+            fetches[(zoomLevel, tileColumn, tileRow)] = (fetched, etag, last_modified)
+      # blank tiles (data None: the canonical one) are stored like the rest,
+      # pointing at the one blank image, and marked in blank_rows
+      tiles = {}
+      blanks = 0
+      for key, data in latest.items():
+         sig = db.blank_sigs.get(key[0])
+         if data is None:
+            if sig is None:
+               continue # nothing known to stand for it
+            tiles[key] = sig
+         else:
+            tiles[key] = (tile_hash(data), data)
+         if sig is not None and tiles[key][0] == sig[0]:
+            db.blank.add(*key)
+            blanks += 1
+         elif sig is not None:
+            db.blank.discard(*key)
+      keys = list(tiles.keys())
+      for key in keys:
+         db.invalidate(*key)
+      # the images being replaced are released once map moves on
+      old_ids = store_tiles(db.c, tiles, db.map_insert(), db.map_row)
+      db.ReleaseImages(old_ids)
+      db.blank.flush()
+      # jobs finish in the same transaction as their tiles
+      db.c.executemany("""UPDATE jobs SET state = 'done', attempts = attempts + 1 WHERE zoom_level = ?
+            AND tile_column = ? AND tile_row = ? AND state != 'done';""", keys)
+      db.c.executemany("""UPDATE jobs SET state = 'failed', attempts = attempts + 1, last_error = ?
+            WHERE zoom_level = ? AND tile_column = ? AND tile_row = ?;""", self.failures)
+      db.c.executemany('INSERT OR REPLACE INTO tile_fetch VALUES (?, ?, ?, ?, ?, ?);',
+            [key + fetch for key, fetch in fetches.items()])
+      db.c.executemany("""UPDATE tile_fetch SET fetched = ? WHERE zoom_level = ? AND tile_column = ?
+            AND tile_row = ?;""", [(self.last_commit,) + key for key in self.unchanged])
+      db.conn.commit()
+      self.written += len(keys)
+      self.blanks += blanks
+      self.commits += 1
+      self.pending = []
+      self.failures = []
+      self.unchanged = []
+
+   def rate(self):
+      elapsed = time.time() - self.start
+      if elapsed <= 0:
+         return 0.0
+      return self.written / elapsed
+
+   def report(self):
+      print('TileWriter: %s tiles in %s commits, %2.1f seconds (%2.1f tiles/s)'%\
+            (self.written,self.commits,time.time()-self.start,self.rate()))
+      if self.blanks:
+         print('TileWriter: %s of them blank, sharing the canonical image'%self.blanks)
+
+def tile_writer_main(filename, tile_queue, sync_queue, batch_size, commit_interval):
+   # body of the writer process, the only connection that writes tiles;
+   # an error is handed to the parent on sync_queue before the process ends
+   try:
+      db = MBTiles(filename)
+      with db.writer(batch_size, commit_interval) as writer:
+         while True:
+            try:
+               item = tile_queue.get(timeout=commit_interval)
+            except Empty:
+               writer.flush()
+               continue
+            if item is None:
+               break
+            if item == 'sync':
+               writer.flush()
+               db.load_blank_signatures() # learn_blank may have run meanwhile
+               sync_queue.put(writer.written)
+               continue
+            if item[0] == 'fail':
+               writer.fail(*item[1:])
+               continue
+            if item[0] == 'touch':
+               writer.touch(*item[1:])
+               continue
+            writer.add(*item)
+   except Exception as e:
+      sync_queue.put(('error', '%s: %s'%(type(e).__name__, e)))
+      raise
+
+class TileWriterProcess(object):
+   # One process owns the write connection for a download. Fetchers put
+   # tiles on its queue and it group-commits them through a TileWriter,
+   # so nothing shares a sqlite connection across fork.
+
+   def __init__(self, filename, batch_size=500, commit_interval=5.0):
+      self.queue = Queue(maxsize=batch_size * 4)
+      self.sync_queue = Queue()
+      self.process = Process(target=tile_writer_main,
+            args=(filename, self.queue, self.sync_queue, batch_size, commit_interval))
+
+   def start(self):
+      self.process.start()
+      return self
+
+   def check(self):
+      # raise the writer's error once its process is gone, rather than
+      # waiting on its queues forever
+      if self.process.is_alive():
+         return
+      try:
+         answer = self.sync_queue.get(timeout=1.0)
+      except Empty:
+         answer = None
+      if isinstance(answer, tuple) and answer[0] == 'error':
+         raise RuntimeError('tile writer failed: %s'%answer[1])
+      raise RuntimeError('tile writer exited (code %s)'%self.process.exitcode)
+
+   def send(self, item):
+      while True:
+         try:
+            self.queue.put(item, timeout=1.0)
+            return
+         except Full:
+            self.check()
+
+   def put(self, zoomLevel, tileColumn, tileRow, data, etag=None, last_modified=None):
+      # a tile just fetched, with the validators the server sent
+      self.send((zoomLevel, tileColumn, tileRow, data, time.time(), etag, last_modified))
+
+   def put_blank(self, zoomLevel, tileColumn, tileRow):
+      self.send((zoomLevel, tileColumn, tileRow, None))
+
+   def fail(self, zoomLevel, tileColumn, tileRow, error):
+      self.send(('fail', zoomLevel, tileColumn, tileRow, error))
+
+   def touch(self, zoomLevel, tileColumn, tileRow):
+      self.send(('touch', zoomLevel, tileColumn, tileRow))
+
+   def sync(self):
+      # wait until everything queued so far is committed
+      self.send('sync')
+      while True:
+         try:
+            answer = self.sync_queue.get(timeout=1.0)
+         except Empty:
+            self.check()
+            continue
+         if isinstance(answer, tuple) and answer[0] == 'error':
+            raise RuntimeError('tile writer failed: %s'%answer[1])
+         return answer
+
+   def close(self):
+      if self.process.is_alive():
+         self.send(None)
+      self.process.join()
+
+def looks_like_html(data):
+   # servers under load answer some tile requests with an html error page
+   head = bytes(data[:512]).lstrip().lower()
+   return head.startswith(b'<') and (b'doctype' in head or b'<html' in head)
+
+class HostLimiter(object):
+   # Paces requests to one tile host: a token bucket refilled at rate per
+   # second caps the request rate, and window caps requests in flight.
+   # Both grow additively while answers come back quickly and cleanly and
+   # halve on 429, 5xx, html error pages or failed requests (AIMD), so the
+   # download settles at the fastest pace the server tolerates.
+
+   def __init__(self, rate=10.0, window=4, max_window=64, min_rate=0.5, max_rate=200.0, slow=2.0):
+      self.rate = float(rate)
+      self.window = window
+      self.max_window = max_window
+      self.min_rate = min_rate
+      self.max_rate = max_rate
+      self.slow = slow # seconds, slower answers do not grow the window
+      self.tokens = 1.0
+      self.refilled = time.time()
+      self.in_flight = 0
+      self.streak = 0 # clean answers since the last change
+      self.last_cut = 0.0
+      self.paused_until = 0.0
+      self.ok = 0
+      self.throttled = 0
+      self.cond = threading.Condition()
+
+   def refill(self, now):
+      self.tokens = min(max(1.0, self.window), self.tokens + (now - self.refilled) * self.rate)
+      self.refilled = now
+
+   def acquire(self):
+      with self.cond:
+         while True:
+            now = time.time()
+            self.refill(now)
+            if now >= self.paused_until and self.tokens >= 1.0 and self.in_flight < self.window:
+               self.tokens -= 1.0
+               self.in_flight += 1
+               return
+            wait = max(self.paused_until - now, (1.0 - self.tokens) / self.rate, 0.01)
+            self.cond.wait(min(wait, 1.0))
+
+   def release(self, status, latency, html=False, retry_after=None):
+      # status None means the request itself failed
+      with self.cond:
+         self.in_flight -= 1
+         now = time.time()
+         if status is None or status == 429 or status >= 500 or html:
+            self.throttled += 1
+            self.streak = 0
+            if retry_after:
+               self.paused_until = max(self.paused_until, now + retry_after)
+            # one cut per round trip, the answers already in flight say the same
+            if now - self.last_cut > max(latency, 1.0):
+               self.window = max(1, self.window // 2)
+               self.rate = max(self.min_rate, self.rate / 2.0)
+               self.last_cut = now
+         else:
+            self.ok += 1
+            if latency < self.slow:
+               self.streak += 1
+               if self.streak >= self.window:
+                  self.window = min(self.max_window, self.window + 1)
+                  self.rate = min(self.max_rate, self.rate + 1.0)
+                  self.streak = 0
+         self.cond.notify_all()
+
+   def cancel(self):
+      # a request given up before its answer (the hedged copy won): the slot
+      # is free again and says nothing about the host
+      with self.cond:
+         self.in_flight -= 1
+         self.cond.notify_all()
+
+   def state(self):
+      with self.cond:
+         return { 'rate': self.rate, 'window': self.window, 'in_flight': self.in_flight,
+                  'ok': self.ok, 'throttled': self.throttled }
+
+   def report(self):
+      state = self.state()
+      return 'rate %2.1f/s window %s (%s in flight) ok %s throttled %s'%\
+            (state['rate'],state['window'],state['in_flight'],state['ok'],state['throttled'])
+
+host_limiters = {} # host -> HostLimiter, shared by every WMTS on that host
+
+def limiter_for(url, **kwargs):
+   host = url.split('://', 1)[-1].split('/', 1)[0]
+   if host not in host_limiters:
+      host_limiters[host] = HostLimiter(**kwargs)
+   return host_limiters[host]
+
+class Mirror(object):
+   # One of the equivalent url templates of a WMTS and its health: moving
+   # averages of latency and of the share of failed requests.
+
+   def __init__(self, template, limiter):
       self.template = template
+      self.limiter = limiter
+      self.latency = 1.0 # seconds
+      self.errors = 0.0
+      self.in_flight = 0
+      self.requests = 0
+      self.wins = 0 # hedged copies that answered first
+
+   def url(self, z, x, y):
+      return self.template.replace('{z}',str(z)).replace('{x}',str(x)).replace('{y}',str(y))
+
+   def score(self):
+      # expected wait, lower is healthier
+      return self.latency * (1 + self.in_flight) / max(0.05, 1.0 - self.errors)
+
+   def record(self, ok, latency):
+      self.requests += 1
+      self.errors = 0.9 * self.errors + (0.0 if ok else 0.1)
+      if ok:
+         self.latency = 0.9 * self.latency + 0.1 * latency
+
+def usable(resp):
+   # an answer worth keeping, anything else is tried on another mirror
+   return resp.status < 500 and resp.status != 429 and \
+         not (resp.status == 200 and looks_like_html(resp.data))
+
+class Attempt(object):
+   # One copy of a request to a mirror. It holds the mirror's in_flight count
+   # from pick() and a limiter slot from the time it starts until it is
+   # closed, either by its own answer or by WMTS.abandon when another copy won.
+
+   def __init__(self, mirror):
+      self.mirror = mirror
+      self.started = threading.Event() # the limiter let it go, see start
+      self.start = None
+      self.resp = None # the answer once its headers are in
+      self.abandoned = False
+      self.closed = False
+
+class WMTS(object):
+   # Tiles from one url template or a list of equivalent ones (mirrors,
+   # subdomains). Each request goes to the healthiest mirror; when it has
+   # not answered by the p95 latency of recent fetches a copy goes to a
+   # mirror on another host, and a failed request is tried on the mirrors
+   # not tried yet. The first good answer wins, the other copy is closed and
+   # its limiter slot handed back at once.
+
+   def __init__(self, template, maxsize=10, hedge=True):
+      # maxsize: connections kept open per host, one per fetch thread and as
+      # many for hedged copies; block makes extra threads wait for one
+      # rather than open more
+      templates = isinstance(template, (list, tuple)) and list(template) or [template]
+      self.template = templates[0]
+      self.maxsize = maxsize
       self.http = urllib3.PoolManager(cert_reqs='CERT_REQUIRED',\
-           ca_certs=certifi.where())
-
-   def get(self,z,x,y):
-      srcurl = "%s"%self.template
-      srcurl = srcurl.replace('{z}',str(z))
-      srcurl = srcurl.replace('{x}',str(x))
-      srcurl = srcurl.replace('{y}',str(y))
-      #print(srcurl[-50:])
-      resp = (self.http.request("GET",srcurl,retries=10))
-      return(resp)
-      
+           ca_certs=certifi.where(), maxsize=maxsize * 2, block=True)
+      # a slow or failing request is hedged or moved to a mirror, not
+      # retried at length here
+      self.retries = urllib3.Retry(total=2, backoff_factor=0.5)
+      self.timeout = urllib3.Timeout(connect=5.0, read=30.0)
+      rate = float(os.environ.get('TILES_PER_SECOND', '10'))
+      self.mirrors = [Mirror(t, limiter_for(t, rate=rate, max_window=maxsize)) for t in templates]
+      self.limiter = self.mirrors[0].limiter
+      # a copy queued behind the same limiter gains nothing, so hedging
+      # needs mirrors on at least two hosts
+      self.hedge = hedge and len(set(m.limiter for m in self.mirrors)) > 1
+      self.lock = threading.Lock()
+      self.tasks = JobQueue() # copies for the helper threads when hedging
+      self.helpers = []
+      self.latencies = deque(maxlen=500) # of answers kept, for the p95
+      self.samples = 0
+      self.hedge_after = None # seconds, None until there are enough samples
+      self.hedged = 0
+      self.hedge_wins = 0
+      self.failovers = 0
+
+   def pick(self, tried, hedge=False):
+      # hedge: only a mirror behind another limiter than the tried ones,
+      # None if there is none
+      with self.lock:
+         if hedge:
+            busy = [m.limiter for m in tried]
+            fresh = [m for m in self.mirrors if m.limiter not in busy]
+            if not fresh:
+               return None
+         else:
+            fresh = [m for m in self.mirrors if m not in tried] or self.mirrors
+         mirror = min(fresh, key=lambda m: m.score())
+         mirror.in_flight += 1
+      return mirror
+
+   def launch(self, mirror, z, x, y, headers, results):
+      # without hedging nothing races the request, it runs in the caller's
+      # thread; with hedging on a helper, so the caller can time it
+      attempt = Attempt(mirror)
+      if not self.hedge:
+         self.run(attempt, z, x, y, headers, results)
+         return attempt
+      with self.lock:
+         if not self.helpers:
+            # one per fetch thread and as many for hedged copies
+            for i in range(self.maxsize * 2):
+               helper = threading.Thread(target=self.help)
+               helper.daemon = True
+               helper.start()
+               self.helpers.append(helper)
+      self.tasks.put((attempt, z, x, y, headers, results))
+      return attempt
+
+   def help(self):
+      while True:
+         self.run(*self.tasks.get())
+
+   def close(self, attempt):
+      # the attempt gives back its in_flight count once; False if it already
+      # has (abandoned), then its answer is dropped
+      with self.lock:
+         if attempt.closed:
+            return False
+         attempt.closed = True
+         attempt.mirror.in_flight -= 1
+      return True
+
+   def abandon(self, attempt):
+      # another copy won: hand back this one's limiter slot now and close its
+      # answer, whatever it is doing; a copy still waiting for its headers
+      # ends by its deadline (see run) without reporting anything
+      with self.lock:
+         if attempt.closed or attempt.abandoned:
+            return
+         attempt.abandoned = True
+         if attempt.start is None:
+            return # not started, run() gives up when the limiter lets it go
+         attempt.closed = True
+         attempt.mirror.in_flight -= 1
+         resp = attempt.resp
+      attempt.mirror.limiter.cancel()
+      if resp is not None:
+         try:
+            resp.close()
+         except Exception:
+            pass
+
+   def run(self, attempt, z, x, y, headers, results):
+      # one copy of a request
+      mirror = attempt.mirror
+      mirror.limiter.acquire()
+      with self.lock:
+         abandoned = attempt.abandoned
+         if abandoned:
+            attempt.closed = True
+            mirror.in_flight -= 1
+         else:
+            attempt.start = start = time.time()
+         timeout = self.timeout
+         if self.hedge and self.hedge_after is not None:
+            # a copy that lost is not waited for longer than this
+            timeout = urllib3.Timeout(connect=5.0, read=min(30.0, max(5.0, 4 * self.hedge_after)))
+      if abandoned:
+         mirror.limiter.cancel()
+         return
+      attempt.started.set()
+      try:
+         resp = self.http.request("GET", mirror.url(z,x,y), headers=headers,
+               retries=self.retries, timeout=timeout, preload_content=False)
+      except Exception as e:
+         if self.close(attempt):
+            self.limiter_release(mirror, None, start)
+            results.put((mirror, None, e))
+         return
+      with self.lock:
+         attempt.resp = resp
+         abandoned = attempt.abandoned
+      if abandoned:
+         # the other copy won, drop this one without reading the body
+         resp.close()
+         resp.release_conn()
+         return
+      try:
+         resp.data # read the body while the connection is ours
+      except Exception as e:
+         resp.release_conn()
+         if self.close(attempt):
+            self.limiter_release(mirror, None, start)
+            results.put((mirror, None, e))
+         return
+      resp.release_conn()
+      if not self.close(attempt):
+         return
+      ok = self.limiter_release(mirror, resp, start)
+      if ok:
+         with self.lock:
+            self.latencies.append(time.time() - start)
+            self.samples += 1
+            if self.samples >= 20 and self.samples % 20 == 0:
+               ordered = sorted(self.latencies)
+               self.hedge_after = ordered[int(len(ordered) * 0.95)]
+      results.put((mirror, resp, None))
+
+   def limiter_release(self, mirror, resp, start):
+      # report an answer (None: the request failed) to the host limiter and
+      # to the mirror's health; returns whether it is usable
+      latency = time.time() - start
+      if resp is None:
+         mirror.limiter.release(None, latency)
+         ok = False
+      else:
+         retry_after = resp.headers.get('Retry-After', '')
+         mirror.limiter.release(resp.status, latency,
+               html=resp.status == 200 and looks_like_html(resp.data),
+               retry_after=float(retry_after) if retry_after.isdigit() else None)
+         ok = usable(resp)
+      with self.lock:
+         mirror.record(ok, latency)
+      return ok
+
+   def get(self,z,x,y,headers=None):
+      # headers: e.g. If-None-Match for a conditional GET (answered 304)
+      results = JobQueue()
+      tried = []
+      attempts = []
+      hedged = False # a copy was sent, or there is no host to send it to
+      copy = None
+      running = 0
+      last = (None, None)
+      try:
+         while True:
+            if running == 0:
+               mirror = self.pick(tried)
+               tried.append(mirror)
+               current = self.launch(mirror, z, x, y, headers, results)
+               attempts.append(current)
+               running += 1
+            wait = None
+            if self.hedge and not hedged and self.hedge_after is not None:
+               # the clock starts once the limiter has let the request go
+               current.started.wait()
+               wait = max(self.hedge_after - (time.time() - current.start), 0.0)
+            try:
+               mirror, resp, error = results.get(timeout=wait)
+            except Empty:
+               # slower than p95: a copy goes to the healthiest other host
+               hedged = True
+               copy = self.pick(tried, hedge=True)
+               if copy is None:
+                  continue
+               with self.lock:
+                  self.hedged += 1
+               tried.append(copy)
+               attempts.append(self.launch(copy, z, x, y, headers, results))
+               running += 1
+               continue
+            running -= 1
+            if resp is not None and usable(resp):
+               if copy is not None and mirror is copy:
+                  with self.lock:
+                     self.hedge_wins += 1
+                     mirror.wins += 1
+               return(resp)
+            last = (resp, error)
+            if running:
+               continue # the other copy may still come good
+            if len(tried) >= len(self.mirrors):
+               break
+            with self.lock:
+               self.failovers += 1
+      finally:
+         for attempt in attempts:
+            self.abandon(attempt)
+      if last[0] is not None:
+         return(last[0])
+      raise last[1]
+
+   def report(self):
+      # lines for FetchEngine.report
+      lines = []
+      for mirror in self.mirrors:
+         lines.append('%s: %s requests, %2.1f%% failing, %2.2fs latency, %s hedges won, %s'%\
+               (mirror.template.split('://', 1)[-1].split('/', 1)[0],mirror.requests,mirror.errors*100,
+               mirror.latency,mirror.wins,mirror.limiter.report()))
+      lines.append('hedged %s requests (%s won by the copy), %s failovers, p95 %s'%\
+            (self.hedged,self.hedge_wins,self.failovers,
+            self.hedge_after is None and '-' or '%2.2fs'%self.hedge_after))
+      return lines
+
+class FetchEngine(object):
+   # A fixed set of threads fetching (z, x, y) jobs from a bounded queue and
+   # handing the tiles to one writer (anything with put(z, x, y, data) and
+   # fail(z, x, y, error), a TileWriterProcess or TileWriter).
+   # Fetching is network bound, so threads cost nothing next to a process
+   # per tile, and no fetch waits for its neighbours to finish.
+   #    engine = FetchEngine(src, tile_writer, workers=16).start()
+   #    engine.put(z, x, y) ... engine.join() ... engine.close()
+
+   def __init__(self, source, writer, workers=8):
+      self.source = source
+      self.writer = writer
+      self.workers = workers
+      self.jobs = JobQueue(maxsize=workers * 4)
+      self.threads = []
+      self.lock = threading.Lock()
+      self.fetched = 0
+      self.failed = 0
+      self.errors = 0 # of the failed, jobs whose fetch raised
+      self.unchanged = 0
+      self.bytes = 0
+      self.start_time = time.time()
+
+   def start(self):
+      for i in range(self.workers):
+         thread = threading.Thread(target=self.run)
+         thread.daemon = True
+         thread.start()
+         self.threads.append(thread)
+      return self
+
+   def run(self):
+      while True:
+         job = self.jobs.get()
+         try:
+            if job is None:
+               return
+            try:
+               size = fetch_tile(job[0], job[1], job[2], self.writer, self.source, *job[3:])
+            except Exception as e:
+               # a bug or a dead writer must not take the thread with it
+               size = None
+               self.crashed(job, e)
+            with self.lock:
+               if size is None:
+                  self.failed += 1
+               elif size == 0:
+                  self.unchanged += 1
+               else:
+                  self.fetched += 1
+                  self.bytes += size
+         finally:
+            self.jobs.task_done()
+
+   def crashed(self, job, error):
+      # record the job as failed when fetching it raised; the writer may be
+      # what failed, then the job stays queued for the next run
+      print('FetchEngine: %s/%s/%s raised %s: %s'%(job[0],job[1],job[2],type(error).__name__,error))
+      with self.lock:
+         self.errors += 1
+      try:
+         self.writer.fail(job[0], job[1], job[2], '%s: %s'%(type(error).__name__, error))
+      except Exception as e:
+         print('FetchEngine: could not record the failure: %s'%e)
+
+   def put(self, zoomLevel, tileColumn, tileRow, etag=None, last_modified=None):
+      # blocks while the queue is full, so a planner cannot run far ahead;
+      # with validators the fetch is conditional
+      self.jobs.put((zoomLevel, tileColumn, tileRow, etag, last_modified))
+
+   def join(self):
+      # wait until every job put so far has been fetched (or has failed)
+      self.jobs.join()
+
+   def close(self):
+      for thread in self.threads:
+         self.jobs.put(None)
+      for thread in self.threads:
+         thread.join()
+      self.threads = []
+      self.report()
+
+   def rate(self):
+      elapsed = time.time() - self.start_time
+      if elapsed <= 0:
+         return 0.0
+      return self.fetched / elapsed
+
+   def report(self):
+      print('FetchEngine: %s tiles, %s failed, %2.1f MB with %s threads (%2.1f tiles/s)'%\
+            (self.fetched,self.failed,self.bytes/1000000.0,self.workers,self.rate()))
+      if self.unchanged:
+         print('FetchEngine: %s tiles not modified (304)'%self.unchanged)
+      if self.errors:
+         print('FetchEngine: %s of the failures raised in the fetch thread'%self.errors)
+      if hasattr(self.source, 'report'):
+         for line in self.source.report():
+            print('FetchEngine: %s'%line)
+         return
+      limiter = getattr(self.source, 'limiter', None)
+      if limiter is not None:
+         print('FetchEngine: %s'%limiter.report())
+
 class Extract(object):
 
     def __init__(self, extract, top, left, bottom, right,
@@ -378,8 +1951,8 @@ def set_up_target_db(region):
    dbname = 'sat_z%s-z13_%s.mbtiles'%(bbox_zoom_start,args.region)
    dbpath = './work/%s'%dbname
    if not os.path.exists(dbpath):
-      shutil.copyfile(args.mbtiles,dbpath) 
-   mbTiles = MBTiles(dbpath)
+      copy_mbtiles(args.mbtiles,dbpath)
+   mbTiles = MBTiles(dbpath, cache_bytes=args.cache*1000000)
    mbTiles.CheckSchema()
    mbTiles.get_bounds()
    config['last_dest'] = dbpath
@@ -395,15 +1968,13 @@ def set_up_new_target_db(region):
    dbname = 'sat_z%s-z13_%s.mbtiles'%(bbox_zoom_start,region)
    dbpath = './work/%s'%dbname
    if not os.path.exists(dbpath):
-      mbTiles = MBTiles(dbpath)
+      mbTiles = MBTiles(dbpath, cache_bytes=args.cache*1000000, clustered=args.clustered)
       print('Initializing schema for %s'%dbpath)
-      with open('tilelive.schema','r') as fp:
-         script = fp.read()
-      mbTiles.execute_script(script)
+      mbTiles.CheckSchema()
       print('Copying zoom %s from %s to %s'%(bbox_zoom_start-1,args.mbtiles,dbpath))
       mbTiles.copy_zoom(str(bbox_zoom_start-1),args.mbtiles)
    else:
-      mbTiles = MBTiles(dbpath)
+      mbTiles = MBTiles(dbpath, cache_bytes=args.cache*1000000)
    mbTiles.CheckSchema()
    mbTiles.get_bounds()
    config['last_dest'] = dbpath
@@ -422,8 +1993,12 @@ def to_dir():
             this_path = os.path.join(prefix,str(zoom),str(col),str(row)+'.jpeg')
             if not os.path.isdir(os.path.dirname(this_path)):
                os.makedirs(os.path.dirname(this_path))
-            raw = get_tile(zoom,col,row)
-            with open(this_path,'w') as fp:
+            try:
+               raw = mbTiles.GetTile(zoom,col,row)
+            except RuntimeError as err:
+               print (err)
+               continue
+            with open(this_path,'wb') as fp:
                fp.write(raw)
 
 def list_tile_sizes():
@@ -451,6 +2026,8 @@ def list_tile_sizes():
                outstr += 'O'
          print(outstr)
          print str(tilelen)
+   if mbTiles.cache:
+      mbTiles.cache.report()
          
 def debug_one_tile():
    if not args.x:
@@ -470,16 +2047,38 @@ def debug_one_tile():
    
 def parse_args():
     parser = argparse.ArgumentParser(description="Display mbtile image.")
+    parser.add_argument("--cache", help="Tile read cache size in MB. (Default=0, off)", type=int, default=0)
     parser.add_argument("-c","--copy", help='Copy -m as src and extend.',action='store_true')
+    parser.add_argument("--compact", help="Release free pages of -m (see --pages, --budget).",action="store_true")
+    parser.add_argument("--pages", help="Most free pages --compact releases.", type=int)
+    parser.add_argument("--budget", help="Seconds --compact may run.", type=float)
+    parser.add_argument("--incremental", help="Switch -m to auto_vacuum=INCREMENTAL (one full VACUUM).",action="store_true")
+    parser.add_argument("--vacuum-into", help="Write a compacted copy of -m to this file.")
     parser.add_argument("-d","--dir", help='Output to this directory (use "." for ./work/)')
+    parser.add_argument("--dedup", help="Merge identical images in -m (one-shot).",action="store_true")
     parser.add_argument("-e", "--extend", help="Get z10-13.",action="store_true")
+    parser.add_argument("--gc", help="Remove images no tile refers to from -m.",action="store_true")
+    parser.add_argument("--mirror", help="Another url template serving the same tiles (repeatable).",action="append")
+    parser.add_argument("--no-hedge", help="Do not send a second copy of requests slower than p95.",action="store_true")
+    parser.add_argument("--geojson", help="With -e, download within the polygon(s) of this GeoJSON file, not the region's box.")
     parser.add_argument("-g", "--get", help='get WMTS tiles from this URL(of "." for Sentinel Cloudless).')
+    parser.add_argument("--landmask", help="With -e, decide water/land from this landmask.py file, not tile sizes.")
     parser.add_argument("-l", "--list", help="List tile sizes.",action="store_true")
     parser.add_argument("-m", "--mbtiles", help="mbtiles filename.")
+    parser.add_argument("--clustered", help="New target files keep tiles in quadkey order.",action="store_true")
+    parser.add_argument("--workers", help="Concurrent tile fetches during downloads. (Default=8)", type=int, default=8)
+    parser.add_argument("--blank", help="Downloads store the water children of ocean tiles as the zoom's blank tile without fetching them.",action="store_true")
+    parser.add_argument("--blank-size", help="Largest image taken as a zoom's blank tile. (Default=%s)"%threshold, type=int)
+    parser.add_argument("--elide-blank", help="Mark the blank tiles of -m in the bitmap (and store those only marked there).",action="store_true")
+    parser.add_argument("--merge", help="Merge tiles from this mbtiles into -m (limit with -r, -z).")
+    parser.add_argument("--conflict", help="On --merge conflicts. (Default=skip)", choices=['skip','replace','newer'], default='skip')
     parser.add_argument("-o", "--onetile", help="Get one tile from source.",action="store_true")
     parser.add_argument("--lat", help="Latitude degrees.",type=float)
     parser.add_argument("--lon", help="Longitude degrees.",type=float)
     parser.add_argument("-r", "--region", help="Region to operate upon.")
+    parser.add_argument("--refresh", help="Re-fetch the tiles of -m that changed upstream (conditional GETs, limit with -z).",action="store_true")
+    parser.add_argument("--older-than", help="With --refresh, only tiles fetched more than this many days ago.", type=float, default=0)
+    parser.add_argument("--rebuild-stats", help="Recompute per zoom statistics for -m.",action="store_true")
     parser.add_argument("-s", "--summarize", help="Data about each zoom level.",action="store_true")
     parser.add_argument("-x",  help="tileX", type=int)
     parser.add_argument("-y",  help="tileY", type=int)
@@ -523,6 +2122,8 @@ def replace_tile(src,zoom,tileX,tileY):
             sys.exit()
          #raw_input("PRESS ENTER")
          mbTiles.SetTile(zoom, tileX, tileY, r.data)
+         mbTiles.record_fetch(zoom, tileX, tileY, r.headers.get('ETag'), r.headers.get('Last-Modified'))
+         mbTiles.Commit()
          returned = mbTiles.GetTile(zoom, tileX, tileY)
          if returned != r.data:
             print('read verify in replace_tile failed')
@@ -614,7 +2215,10 @@ def view_tiles(stdscr):
          proc = subprocess.Popen(['killall','display'])
          proc.communicate()
          break  # Exit the while()
-      if ch == curses.KEY_UP:
+      if ch == ord('c') and mbTiles.cache:
+         stdscr.addstr(2,0,str(mbTiles.cache.stats()))
+         stdscr.getch()
+      elif ch == curses.KEY_UP:
          if not state['tileY'] == bounds[state['zoom']]['minY']:
             state['tileY'] -= 1
       elif ch == curses.KEY_RIGHT:
@@ -678,13 +2282,21 @@ def bbox_tile_limits(west, south, east, north, zoom):
    return(sw[0],ne[0]+1, ne[1], sw[1]+1)
 
 def record_bbox_debug_info(region):
-   cur_box = regions[region]
+   # the tiles of the region's polygon (or box), and the box around them
+   global region_tiles
+   if args.geojson:
+      region_tiles = geojson_cover(args.geojson, 13)
+   else:
+      region_tiles = region_cover(regions[region], 13)
+   if region_tiles.count(13) == 0:
+      print('%s covers no tiles, check the polygon or the region bounds'%(args.geojson or region))
+      sys.exit(1)
    for zoom in range(bbox_zoom_start-1,14):
-      xmin,xmax,ymin,ymax = bbox_tile_limits(cur_box['west'],cur_box['south'],\
-            cur_box['east'],cur_box['north'],zoom)
+      xmin,xmax,ymin,ymax = region_tiles.bbox(zoom)
       #print(xmin,xmax,ymin,ymax,zoom)
       tot_tiles = mbTiles.CountTiles(zoom)
-      bbox_limits[zoom] = { 'minX': xmin,'maxX':xmax,'minY':ymin,'maxY':ymax,                              'count':tot_tiles}
+      bbox_limits[zoom] = { 'minX': xmin,'maxX':xmax,'minY':ymin,'maxY':ymax,                              'count':tot_tiles,
+                            'cover':region_tiles.count(zoom)}
    with open('./work/bbox_limits','w') as fp:
       fp.write(json.dumps(bbox_limits,indent=2))
 
@@ -703,30 +2315,155 @@ def get_accumulators(zoom):
       int(str(data.get('tileX',0))),\
       int(str(data.get('tileY',0))),\
       int(str(data.get('count',0))),\
-      bool(str(data.get('done',False)))\
+      str(data.get('done','False')) == 'True'\
    )
 
-def fetch_quad_for(tileX, tileY, zoom):
-   # get 4 tiles for zoom+1
-   lock = Lock()
-   p1 = Process(target=mbTiles.DownloadTile, args=(zoom+1,tileX*2,tileY*2,lock))
-   p1.start()
-   p2 = Process(target=mbTiles.DownloadTile, args=(zoom+1,tileX*2+1,tileY*2,lock))
-   p2.start()
-   p3 = Process(target=mbTiles.DownloadTile, args=(zoom+1,tileX*2,tileY*2+1,lock))
-   p3.start()
-   p4 = Process(target=mbTiles.DownloadTile, args=(zoom+1,tileX*2+1,tileY*2+1,lock))
-   p4.start()
-   p1.join()
-   p2.join()
-   p3.join()
-   p4.join()
-
+def fetch_tile(zoomLevel, tileColumn, tileRow, writer, source=None, etag=None, last_modified=None):
+   # runs in a FetchEngine thread: fetch only, the writer process stores the
+   # tile; returns its size, 0 when the server says the stored tile is
+   # current (304 to a conditional GET), None on failure
+   headers = {}
+   if etag:
+      headers['If-None-Match'] = etag
+   if last_modified:
+      headers['If-Modified-Since'] = last_modified
+   try:
+      r = (source or src).get(zoomLevel,tileColumn,tileRow,headers=headers or None)
+   except Exception as e:
+      print('Source data failure;%s'%e)
+      writer.fail(zoomLevel, tileColumn, tileRow, e)
+      return None
+   if r.status == 200 and looks_like_html(r.data):
+      print('Sat data error, html page for %s/%s/%s'%(zoomLevel,tileColumn,tileRow))
+      writer.fail(zoomLevel, tileColumn, tileRow, 'html')
+      return None
+   if r.status == 304:
+      writer.touch(zoomLevel, tileColumn, tileRow)
+      return 0
+   if r.status == 200:
+      writer.put(zoomLevel, tileColumn, tileRow, r.data,
+            r.headers.get('ETag'), r.headers.get('Last-Modified'))
+      return len(r.data)
+   print('Sat data error, returned:%s'%r.status)
+   writer.fail(zoomLevel, tileColumn, tileRow, 'http %s'%r.status)
+   return None
+
+def fetch_quad_for(tileX, tileY, zoom, existing=None):
+   # get 4 tiles for zoom+1, skipping the ones already present
+   # existing: TilePresence for zoom+1, saves a TileExists query per child
+   # the children are queued on fetch_engine, nothing waits for them here
+   for x, y in ((tileX*2,tileY*2),(tileX*2+1,tileY*2),(tileX*2,tileY*2+1),(tileX*2+1,tileY*2+1)):
+      if existing is not None:
+         if (x, y) in existing:
+            continue
+      elif mbTiles.TileExists(zoom+1,x,y):
+         continue
+      fetch_engine.put(zoom+1,x,y)
+
+
+def child_state(zoom, tileX, tileY, parent_size):
+   # 'water' or 'land' for a tile of zoom, from the land mask when it has the
+   # tile, else from the size of its parent: small parents are ocean, a
+   # missing one (perhaps a failed fetch) says nothing (None)
+   if landmask is not None:
+      state = landmask.state(zoom, tileX, tileY)
+      if state is not None:
+         return state
+   if parent_size > threshold:
+      return 'land'
+   if parent_size > 0:
+      return 'water'
+   return None
+
+def sample_blank(zoom):
+   # with a land mask the water tiles are never fetched, so there may be no
+   # blank tile of zoom to learn from: fetch one tile the mask says is water
+   # and take it as the blank tile
+   if landmask is None:
+      return False
+   for tileX, tileY in region_tiles.tiles(zoom-1):
+      for x, y in ((tileX*2,tileY*2),(tileX*2+1,tileY*2),(tileX*2,tileY*2+1),(tileX*2+1,tileY*2+1)):
+         if (zoom, x, y) not in region_tiles or landmask.state(zoom, x, y) != 'water':
+            continue
+         try:
+            r = src.get(zoom, x, y)
+         except Exception as e:
+            print('Source data failure;%s'%e)
+            return False
+         if r.status != 200 or looks_like_html(r.data):
+            print('no blank sample for zoom %s, %s/%s/%s returned:%s'%(zoom,zoom,x,y,r.status))
+            return False
+         mbTiles.set_blank(zoom, bytes(r.data))
+         print('zoom %s: blank tile taken from water tile %s/%s'%(zoom,x,y))
+         return True
+   return False
+
+def mark_blank_children(zoom, present, existing):
+   # learn zoom+1's blank tile from what was fetched (or one water tile of
+   # the mask), then mark the water children of zoom blank instead of
+   # leaving them out
+   mbTiles.learn_blank(zoom+1, args.blank_size)
+   if zoom+1 not in mbTiles.blank_sigs:
+      sample_blank(zoom+1)
+   if zoom+1 not in mbTiles.blank_sigs:
+      print('no blank tile known for zoom %s, children of ocean tiles left out'%(zoom+1))
+      return
+   marked = 0
+   for tileX, tileY in region_tiles.tiles(zoom):
+      size = present.size(tileX, tileY)
+      for x, y in ((tileX*2,tileY*2),(tileX*2+1,tileY*2),(tileX*2,tileY*2+1),(tileX*2+1,tileY*2+1)):
+         if (x, y) not in existing and (zoom+1, x, y) in region_tiles and \
+               child_state(zoom+1, x, y, size) == 'water':
+            tile_writer.put_blank(zoom+1, x, y)
+            marked += 1
+   tile_writer.sync()
+   print('zoom %s: %s tiles marked blank without fetching'%(zoom+1,marked))
 
 def is_done(zoom):
    data = mbTiles.GetSatMetaData(zoom)
    #print('zoom:%s data:%s'%(zoom,data))
-   return bool(data.get('done',False))
+   return str(data.get('done','False')) == 'True'
+
+def plan_zoom(zoom, present, children):
+   # queue the missing land children of zoom, once per zoom; only tiles of
+   # the region's cover, not the whole box around it
+   ocean = land = 0
+   jobs = []
+   for xtile, ytile in region_tiles.tiles(zoom):
+      size = present.size(xtile, ytile)
+      for x, y in ((xtile*2,ytile*2),(xtile*2+1,ytile*2),(xtile*2,ytile*2+1),(xtile*2+1,ytile*2+1)):
+         if child_state(zoom+1, x, y, size) != 'land':
+            ocean += 1
+            continue
+         land += 1
+         if (x, y) not in children and (zoom+1, x, y) in region_tiles:
+            jobs.append((zoom+1, x, y))
+      if len(jobs) >= 10000:
+         mbTiles.add_jobs(jobs)
+         jobs = []
+   mbTiles.add_jobs(jobs)
+   put_accumulators(zoom,ocean,land)
+   mbTiles.SetSatMetaData(zoom,'planned','True')
+   print('zoom %s planned: land:%s ocean:%s jobs:%s'%(zoom,land,ocean,mbTiles.job_counts(zoom+1)))
+
+def drain_jobs(zoom, max_attempts=3):
+   # fetch the pending jobs of zoom, then retry the failed ones a few times
+   for attempt in range(max_attempts):
+      start = time.time()
+      queued = 0
+      for job in mbTiles.pending_jobs(zoom):
+         fetch_engine.put(*job)
+         queued += 1
+         if queued % 1000 == 0:
+            sys.stdout.write('\nzoom %s: %s queued, %2.1f tiles/s %s'%\
+                  (zoom,queued,queued/(time.time()-start),src.limiter.report()))
+      fetch_engine.join()
+      tile_writer.sync()
+      if not mbTiles.retry_jobs(zoom, max_attempts):
+         break
+   counts = mbTiles.job_counts(zoom)
+   print('\nzoom %s jobs: %s'%(zoom,counts))
+   return counts
   
 def download_region(region):
    global src # the opened url for satellite images
@@ -735,8 +2472,8 @@ def download_region(region):
    dbname = 'sat-%s-sentinel-z0_13.mbtiles'%region
    dbpath = './work/%s'%dbname
    if not os.path.exists(dbpath):
-      shutil.copyfile('./satellite.mbtiles',dbpath) 
-   mbTiles = MBTiles(dbpath)
+      copy_mbtiles('./satellite.mbtiles',dbpath)
+   mbTiles = MBTiles(dbpath, cache_bytes=args.cache*1000000)
    mbTiles.get_bounds()
    # print some summary info for this region
    stdscr.addstr(1,0,"ZOOM")
@@ -783,57 +2520,82 @@ def extend_region(region):
    # Open a WMTS source
    global src # the opened url for satellite images
    try:
-      src = WMTS(url)
+      src = WMTS([url] + (args.mirror or []), maxsize=args.workers, hedge=not args.no_hedge)
    except:
       print('failed to open source')
       sys.exit(1)
+   global tile_writer, fetch_engine, landmask
+   if args.landmask:
+      from landmask import LandMask # landmask imports this module
+      landmask = LandMask(args.landmask)
+   tile_writer = TileWriterProcess(mbTiles.filename).start()
+   fetch_engine = FetchEngine(src, tile_writer, args.workers).start()
    # Look at tiles we alrady have to predict which to get at zoom+1
-   start = start_pd = time.time()
+   start = time.time()
    for zoom in range(bbox_zoom_start-1,13):
       print("new zoom level:%s"%zoom)
 
-      if is_done(zoom + 1): 
+      if is_done(zoom): 
          print('skipping complete zoom level %s'%zoom)
          continue      
  
-      ocean, land, startx, starty, count, done = get_accumulators(zoom)
-      start_pd = time.time()
-      land_pd = land
-
-      for ytile in range(bbox_limits[zoom]['minY'],bbox_limits[zoom]['maxY']+1):
-         mbTiles.SetSatMetaData(zoom,'tileY',str(ytile))
-         for xtile in range(bbox_limits[zoom]['minX'],bbox_limits[zoom]['maxX']+1):
-            if xtile % 20 == 0:
-               mbTiles.SetSatMetaData(zoom,'tileX',str(xtile))
-               if start_pd != time.time():
-                  rate = (land - land_pd) / (time.time() - start_pd)
-                  start_pd = time.time()
-                  land_pd = land
-                  sys.stdout.write('\nRate:%s Ocean:%s Land:%s'%(rate,ocean,land,))
-            if mbTiles.TileExists(zoom,xtile,ytile):
-               try:
-                  raw = mbTiles.GetTile(zoom, xtile, ytile)
-               except Exception as e:
-                  print('GetTile Exception. Zoom:%s x:%s y:%s Returned %s'%(zoom,xtile,ytile,str(e)))
-               if len(raw) > threshold:
-                  land += 4
-                  fetch_quad_for(xtile, ytile, zoom)
-               else:
-                  ocean += 4
-            else:
-               ocean += 4
-            sys.stdout.write('.')
-         print("ytile row completed:%s."%ytile)
-         print('Total time:%s Total_tiles:%s'%(time.time()-start,land))
-         
-      print('zoom %s completed'%zoom)
-      done = True
-      put_accumulators(zoom,ocean,land,count,done)
-   ocean, land, startx, starty, count, done = get_accumulators(zoom)
-   print('Total time:%s Total_tiles:%s'%(time.time()-start,land))
+      # the work for zoom+1 is planned once into the jobs table, a restart
+      # goes straight back to draining what is still pending
+      limits = bbox_limits[zoom]
+      if str(mbTiles.GetSatMetaData(zoom).get('planned','False')) == 'True':
+         print('zoom %s already planned: %s'%(zoom,mbTiles.job_counts(zoom+1)))
+      else:
+         # what is on disk for this zoom and the next, loaded once per zoom
+         present = mbTiles.load_presence(zoom,(limits['minX'],limits['maxX'],\
+               limits['minY'],limits['maxY']),sizes=True)
+         children = mbTiles.load_presence(zoom+1,(limits['minX']*2,limits['maxX']*2+1,\
+               limits['minY']*2,limits['maxY']*2+1))
+         plan_zoom(zoom, present, children)
+      drain_jobs(zoom+1)
+      if args.blank:
+         # the water children were not fetched, mark them blank
+         present = mbTiles.load_presence(zoom,(limits['minX'],limits['maxX'],\
+               limits['minY'],limits['maxY']),sizes=True)
+         children = mbTiles.load_presence(zoom+1,(limits['minX']*2,limits['maxX']*2+1,\
+               limits['minY']*2,limits['maxY']*2+1))
+         mark_blank_children(zoom, present, children)
+      print('zoom %s completed, total time:%s'%(zoom,time.time()-start))
+      mbTiles.SetSatMetaData(zoom,'done','True')
+   fetch_engine.close()
+   tile_writer.close()
+   print('Total time:%s'%(time.time()-start))
+   if mbTiles.cache:
+      mbTiles.cache.report()
    mbTiles.delete_zoom(bbox_zoom_start-1)
    set_metadata(region)
 
+def refresh_tiles(zooms, before):
+   # conditional GETs for the stored tiles of zooms last fetched before the
+   # time before, oldest first. A tile the server still has costs a 304 and
+   # a new fetch time, so an interrupted refresh picks up where it stopped.
+   global src, tile_writer, fetch_engine
+   try:
+      src = WMTS([url] + (args.mirror or []), maxsize=args.workers, hedge=not args.no_hedge)
+   except:
+      print('failed to open source')
+      sys.exit(1)
+   tile_writer = TileWriterProcess(mbTiles.filename).start()
+   fetch_engine = FetchEngine(src, tile_writer, args.workers).start()
+   start = time.time()
+   for zoom in zooms:
+      queued = 0
+      for job in mbTiles.stale_tiles(zoom, before):
+         fetch_engine.put(*job)
+         queued += 1
+         if queued % 1000 == 0:
+            sys.stdout.write('\nzoom %s: %s refreshed, %2.1f tiles/s %s'%\
+                  (zoom,queued,queued/(time.time()-start),src.limiter.report()))
+      fetch_engine.join()
+      tile_writer.sync()
+      print('\nzoom %s: %s tiles checked, total time:%s'%(zoom,queued,time.time()-start))
+   fetch_engine.close()
+   tile_writer.close()
+
 def make_sat_extension(region):
    set_up_new_target_db(region)
    extend_region(region)
@@ -883,13 +2645,53 @@ def main():
       else:  # fall back to symbolic link
          args.mbtiles = '%s/satellite.mbtiles'%os.getcwd()
    print args.mbtiles
-   mbTiles  = MBTiles(args.mbtiles)
+   # the tile size listing only reads, share the file read-only
+   mbTiles  = MBTiles(args.mbtiles, cache_bytes=args.cache*1000000, readonly=bool(args.list))
    mbTiles.get_bounds()
    print('SOURCE mbtiles filename:%s'%args.mbtiles)
 
    if args.summarize:
       mbTiles.summarize()
       sys.exit(0)
+   if args.dedup:
+      mbTiles.dedup_images()
+      sys.exit(0)
+   if args.gc:
+      mbTiles.collect_garbage()
+      sys.exit(0)
+   if args.rebuild_stats:
+      mbTiles.rebuild_stats()
+      sys.exit(0)
+   if args.elide_blank:
+      mbTiles.CheckSchema()
+      for zoom in [row[0] for row in mbTiles.c.execute('SELECT zoom_level FROM zoom_stats ORDER BY zoom_level').fetchall()]:
+         mbTiles.learn_blank(zoom, args.blank_size)
+      sys.exit(0)
+   if args.incremental:
+      mbTiles.enable_incremental_vacuum()
+      sys.exit(0)
+   if args.compact:
+      mbTiles.compact(args.pages,args.budget)
+      sys.exit(0)
+   if args.vacuum_into:
+      mbTiles.vacuum_into(args.vacuum_into)
+      sys.exit(0)
+   if args.merge:
+      bbox = zooms = None
+      if args.region:
+         cur_box = regions[args.region]
+         bbox = (cur_box['west'],cur_box['south'],cur_box['east'],cur_box['north'])
+      if args.zoom:
+         zooms = range(args.zoom,14)
+      mbTiles.merge_from(args.merge,zooms=zooms,bbox=bbox,on_conflict=args.conflict)
+      sys.exit(0)
+   if args.refresh:
+      mbTiles.CheckSchema()
+      zooms = [row[0] for row in mbTiles.c.execute('SELECT zoom_level FROM zoom_stats ORDER BY zoom_level').fetchall()]
+      if args.zoom:
+         zooms = [zoom for zoom in zooms if zoom >= args.zoom]
+      refresh_tiles(zooms, time.time() - args.older_than * 24 * 3600)
+      sys.exit(0)
    if args.onetile:
       debug_one_tile()
       sys.exit(0)
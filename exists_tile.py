@@ -4,30 +4,21 @@
 # server.py
 
 import os
-from flask import Flask,request,g
-import sqlite3
+from flask import Flask,request
 import json
 import math
 from flask_cors import CORS
+from readpool import ReadPool
 
 application = Flask(__name__)
 cors = CORS(application)
 DATABASE = './detail.mbtiles'
 bounds = {}
+# per-thread read-only connections, kept open across requests
+pool = ReadPool(DATABASE)
 
 def get_db():
-    db = getattr(g, '_database', None)
-    if db is None:
-       db = g._database = sqlite3.connect(DATABASE)
-       db.row_factory = sqlite3.Row
-       print("opening Database")
-    return db
-
-@application.teardown_appcontext
-def close_connection(exception):
-    db = getattr(g, '_database', None)
-    if db is not None:
-        db.close()
+    return pool.connection()
 
 @application.route('/')
 def exists():
@@ -78,7 +69,12 @@ def exists():
 @application.route('/summary')
 def summary():
     cur = get_db().cursor()
-    sql = 'select zoom_level, min(tile_column),max(tile_column),min(tile_row),max(tile_row), count(zoom_level) from tiles group by zoom_level;'
+    # map/images files written by download.py keep these counts in zoom_stats
+    cur.execute("select count(*) from sqlite_master where name = 'zoom_stats'")
+    if cur.fetchone()[0]:
+        sql = 'select zoom_level, min_column, max_column, min_row, max_row, tile_count from zoom_stats order by zoom_level;'
+    else:
+        sql = 'select zoom_level, min(tile_column),max(tile_column),min(tile_row),max(tile_row), count(zoom_level) from tiles group by zoom_level;'
     cur.execute(sql)
     rows = cur.fetchall()
     outstr ='Zoom Levels Found:%s'%len(rows) + '<br>'
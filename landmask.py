@@ -0,0 +1,233 @@
+#!/usr/bin/env python2
+# -*- coding: UTF-8 -*-
+# Water/land mask per zoom from the OpenMapTiles vector tiles (osm.mbtiles),
+# so download.py can leave open ocean out of a satellite download without
+# guessing from the size of the parent JPEG.
+# A tile is water when the polygons of the water layer cover it and the
+# landcover layer has nothing in it; anything else with a vector tile is
+# land. Tiles are decoded in a process pool and kept as two TileBitmaps,
+# water_rows and land_rows, rows in WMTS order (osm.mbtiles rows are TMS).
+#  landmask.py -i osm.mbtiles -o landmask.sqlite -z 10 11 12 13
+
+import sqlite3
+import sys, os
+import argparse
+import gzip
+import io
+import time
+from multiprocessing import Pool
+from download import tile_chunks
+from readpool import connect_readonly
+from tilebitmap import TileBitmap
+try:
+   from VectorTile import DecodeVectorTile, DecodeVectorTileResults
+except ImportError: # protobuf missing, only building a mask needs it
+   DecodeVectorTile = None
+   DecodeVectorTileResults = object
+
+# GLOBALS
+args = object
+
+TOLERANCE = 0.001 # water may leave this fraction of a tile uncovered
+
+def clip_ring(ring, low=0.0, high=1.0):
+   # Sutherland-Hodgman against the unit square, ring of (x, y) fractions
+   for axis in (0, 1):
+      for bound, keep in ((low, lambda v: v >= low), (high, lambda v: v <= high)):
+         out = []
+         for i in range(len(ring)):
+            a = ring[i - 1]
+            b = ring[i]
+            if keep(b[axis]):
+               if not keep(a[axis]):
+                  out.append(crossing(a, b, axis, bound))
+               out.append(b)
+            elif keep(a[axis]):
+               out.append(crossing(a, b, axis, bound))
+         ring = out
+         if not ring:
+            return ring
+   return ring
+
+def crossing(a, b, axis, bound):
+   t = (bound - a[axis]) / (b[axis] - a[axis])
+   point = [a[0] + t * (b[0] - a[0]), a[1] + t * (b[1] - a[1])]
+   point[axis] = bound
+   return tuple(point)
+
+def ring_area(ring):
+   total = 0.0
+   for i in range(len(ring)):
+      x1, y1 = ring[i - 1]
+      x2, y2 = ring[i]
+      total += x1 * y2 - x2 * y1
+   return abs(total) / 2.0
+
+class WaterArea(DecodeVectorTileResults):
+   # DecodeVectorTile output: how much of the tile the water layer covers,
+   # and whether the landcover layer has anything
+
+   def __init__(self):
+      self.layer = None
+      self.water = 0.0
+      self.landcover = 0
+      self.decoder = None # set once the decoder exists, for the tile bounds
+
+   def NumLayers(self, numLayers):
+      pass
+
+   def LayerStart(self, name, version, extent=4096):
+      self.layer = name
+
+   def LayerEnd(self):
+      self.layer = None
+
+   def fraction(self, ring):
+      # the decoder maps tile space linearly onto lon/lat, undo that
+      d = self.decoder
+      return [((lon - d.lonMin) / d.dLon, (d.latMax - lat) / d.dLat) for lon, lat in ring]
+
+   def Feature(self, typeEnum, id, tagDict, points, lines, polygons):
+      if self.layer == 'landcover':
+         self.landcover += 1
+      elif self.layer == 'water':
+         for polygon in polygons:
+            if not polygon or not polygon[0]:
+               continue
+            self.water += ring_area(clip_ring(self.fraction(polygon[0])))
+            for hole in polygon[1]:
+               self.water -= ring_area(clip_ring(self.fraction(hole)))
+
+   def Finish(self):
+      pass
+
+def classify(job):
+   # runs in the pool: (zoom, x, y, 'water' or 'land'), y in WMTS order
+   zoom, tileColumn, tmsRow, data, tolerance = job
+   tileRow = (1 << zoom) - 1 - tmsRow
+   if data[:2] == b'\x1f\x8b':
+      data = gzip.GzipFile(fileobj=io.BytesIO(data)).read()
+   area = WaterArea()
+   decoder = DecodeVectorTile(zoom, tileColumn, tileRow, area)
+   area.decoder = decoder
+   decoder.DecodeTileData(data)
+   if area.water >= 1.0 - tolerance and not area.landcover:
+      return (zoom, tileColumn, tileRow, 'water')
+   return (zoom, tileColumn, tileRow, 'land')
+
+class LandMask(object):
+   # The bitmaps of a mask file. state() is 'water', 'land' or None when the
+   # mask has no vector tile for it; deeper than the mask goes, the tiles
+   # under a water tile are water and the rest unknown.
+
+   def __init__(self, filename):
+      self.conn = sqlite3.connect(filename)
+      self.conn.text_factory = str
+      self.water = TileBitmap(lambda: self.conn, 'water_rows')
+      self.land = TileBitmap(lambda: self.conn, 'land_rows')
+      self.rows = {} # (table, zoom, tile_row) -> bits, the planner asks row by row
+      self.max_zoom = None
+
+   def create(self):
+      self.water.create()
+      self.land.create()
+      self.conn.commit()
+
+   def zooms(self):
+      sql = 'SELECT zoom_level FROM water_rows UNION SELECT zoom_level FROM land_rows ORDER BY 1'
+      return [row[0] for row in self.conn.execute(sql)]
+
+   def marked(self, bitmap, zoom, tileColumn, tileRow):
+      key = (bitmap.table, zoom, tileRow)
+      if key not in self.rows:
+         self.rows[key] = bitmap.load_row(zoom, tileRow)
+      bits = self.rows[key]
+      if bits is None or tileColumn >> 3 >= len(bits):
+         return False
+      return bits[tileColumn >> 3] & (1 << (tileColumn & 7)) != 0
+
+   def state(self, zoom, tileColumn, tileRow):
+      if self.max_zoom is None:
+         self.max_zoom = max(self.zooms() or [-1])
+      if zoom > self.max_zoom:
+         shift = zoom - self.max_zoom
+         if self.marked(self.water, self.max_zoom, tileColumn >> shift, tileRow >> shift):
+            return 'water'
+         return None
+      if self.marked(self.water, zoom, tileColumn, tileRow):
+         return 'water'
+      if self.marked(self.land, zoom, tileColumn, tileRow):
+         return 'land'
+      return None
+
+   def close(self):
+      self.conn.commit()
+      self.conn.close()
+
+def build(src, dest, zooms=None, processes=None, chunk=2000, tolerance=TOLERANCE):
+   # (re)build the mask of zooms in dest from the vector tiles in src
+   if DecodeVectorTile is None:
+      raise RuntimeError('decoding vector tiles needs protobuf (pip install protobuf)')
+   conn = connect_readonly(src)
+   c = conn.cursor()
+   mask = LandMask(dest)
+   mask.create()
+   pool = Pool(processes)
+   stats = {} # zoom -> [tiles, water]
+   start = time.time()
+   try:
+      for zoom in zooms or ():
+         mask.water.clear_zoom(zoom)
+         mask.land.clear_zoom(zoom)
+         stats[zoom] = [0, 0]
+      for rows in tile_chunks(c, zooms, chunk):
+         jobs = []
+         for zoom, tileColumn, tileRow, data in rows:
+            if zoom not in stats:
+               # without -z each zoom found is rebuilt, cleared before its first tile
+               mask.water.clear_zoom(zoom)
+               mask.land.clear_zoom(zoom)
+               stats[zoom] = [0, 0]
+            jobs.append((zoom, tileColumn, tileRow, bytes(data), tolerance))
+         for zoomLevel, tileColumn, tileRow, state in pool.imap_unordered(classify, jobs, 16):
+            stats[zoomLevel][0] += 1
+            if state == 'water':
+               stats[zoomLevel][1] += 1
+               mask.water.add(zoomLevel, tileColumn, tileRow)
+            else:
+               mask.land.add(zoomLevel, tileColumn, tileRow)
+         mask.water.flush()
+         mask.land.flush()
+         mask.conn.commit()
+   finally:
+      pool.close()
+      pool.join()
+      mask.close()
+      conn.close()
+   print('zoom      tiles      water       land')
+   for zoom in sorted(stats):
+      tiles, water = stats[zoom]
+      print('%4s %10s %10s %10s'%(zoom,tiles,water,tiles-water))
+   print('%s tiles in %2.1f seconds'%(sum(stat[0] for stat in stats.values()),time.time()-start))
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Build a water/land tile mask from OpenMapTiles vector tiles.")
+    parser.add_argument("-i", "--input", help="Vector mbtiles. (Default=osm.mbtiles)", default='osm.mbtiles')
+    parser.add_argument("-o", "--output", help="Mask file. (Default=landmask.sqlite)", default='landmask.sqlite')
+    parser.add_argument("-z", "--zoom", help="Only these zoom levels.", type=int, nargs='*')
+    parser.add_argument("-p", "--processes", help="Decoder processes. (Default=cpu count)", type=int)
+    parser.add_argument("--tolerance", help="Uncovered fraction still counted as water. (Default=%s)"%TOLERANCE,
+          type=float, default=TOLERANCE)
+    return parser.parse_args()
+
+def main():
+   global args
+   args = parse_args()
+   if not os.path.isfile(args.input):
+      print('%s not found'%args.input)
+      sys.exit(1)
+   build(args.input, args.output, args.zoom, args.processes, tolerance=args.tolerance)
+   sys.exit(0)
+
+if __name__ == "__main__":
+   main()
@@ -0,0 +1,50 @@
+#!/usr/bin/env python
+# -*- coding: UTF-8 -*-
+# Batched writes to the map/images layout, shared by download.TileWriter
+# (python2) and aggregate.MBTiles (python3). Keys already in map are updated
+# and only new keys and images are inserted, so files without the unique
+# indexes on map and images (the original schema) do not collect duplicates.
+
+import sqlite3
+
+MAP_INSERT = ('zoom_level, tile_column, tile_row, tile_id', '?, ?, ?, ?')
+
+def store_tiles(c, tiles, map_insert=MAP_INSERT, map_row=None, update=True):
+   # tiles: {(zoom, x, y): (tile_id, data)}.
+   # map_insert/map_row: (columns, placeholders) and the row for a new key,
+   # for maps with extra columns (the clustered tile_key).
+   # update=False leaves keys already in map as they are.
+   # Returns the tile_ids these keys no longer use, the caller releases them
+   # and commits.
+   keys = list(tiles.keys())
+   c.execute('CREATE TEMP TABLE IF NOT EXISTS pending_keys (zoom_level INTEGER, tile_column INTEGER, tile_row INTEGER)')
+   c.execute('DELETE FROM temp.pending_keys')
+   c.executemany('INSERT INTO temp.pending_keys VALUES (?, ?, ?)', keys)
+   existing = {}
+   for zoomLevel, tileColumn, tileRow, tile_id in c.execute("""SELECT p.zoom_level, p.tile_column,
+         p.tile_row, map.tile_id FROM temp.pending_keys p JOIN map ON map.zoom_level = p.zoom_level
+         AND map.tile_column = p.tile_column AND map.tile_row = p.tile_row""").fetchall():
+      existing[(zoomLevel, tileColumn, tileRow)] = str(tile_id)
+   images = {}
+   for tile_id, data in tiles.values():
+      images[tile_id] = data
+   # one pass over images for the ids it already has
+   c.execute('CREATE TEMP TABLE IF NOT EXISTS pending_ids (tile_id TEXT)')
+   c.execute('DELETE FROM temp.pending_ids')
+   c.executemany('INSERT INTO temp.pending_ids VALUES (?)', [(tile_id,) for tile_id in images])
+   stored = set(str(row[0]) for row in c.execute("""SELECT DISTINCT images.tile_id FROM images
+         JOIN temp.pending_ids p ON p.tile_id = images.tile_id""").fetchall())
+   c.executemany('INSERT INTO images (tile_data, tile_id) VALUES (?, ?);',
+         [(sqlite3.Binary(data), tile_id) for tile_id, data in images.items() if tile_id not in stored])
+   if update:
+      c.executemany('UPDATE map SET tile_id = ? WHERE zoom_level = ? AND tile_column = ? AND tile_row = ?;',
+            [(tiles[key][0],) + key for key in keys if key in existing and existing[key] != tiles[key][0]])
+   new = [key + (tiles[key][0],) for key in keys if key not in existing]
+   if map_row is not None:
+      new = [map_row(*row) for row in new]
+   c.executemany('INSERT INTO map (%s) VALUES (%s);'%map_insert, sorted(new))
+   if not update:
+      return set()
+   old_ids = set(existing.values())
+   old_ids.difference_update(images)
+   return old_ids
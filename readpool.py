@@ -0,0 +1,59 @@
+#!/usr/bin/env python
+# -*- coding: UTF-8 -*-
+# Read-only sqlite connections for tile readers (exists_tile.py, the viewers).
+# Each thread gets its own connection, opened with mode=ro, memory mapped and
+# with a large page cache, so random tile reads are served from the OS page
+# cache through mmap instead of read() syscalls.
+# Python 2's sqlite3 cannot open file: URIs, so there the file is opened
+# read-write and only PRAGMA query_only keeps the connection from writing;
+# sqlite still maps it read-only for reads, but mode=ro (no write lock, a
+# file on read-only media) needs Python 3.
+
+import os
+import sqlite3
+import threading
+try:
+   from urllib.request import pathname2url
+except ImportError:
+   from urllib import pathname2url
+
+MMAP_SIZE = 256 * 1024 * 1024 # bytes of the file to map
+CACHE_KB = 64 * 1024 # page cache per connection
+
+def connect_readonly(filename, mmap_size=MMAP_SIZE, cache_kb=CACHE_KB):
+   uri = 'file:%s?mode=ro'%pathname2url(os.path.abspath(filename))
+   try:
+      conn = sqlite3.connect(uri, uri=True)
+   except TypeError: # python2 sqlite3 cannot open URIs, query_only still guards it
+      if not os.path.isfile(filename):
+         # a read-write open would create an empty file
+         raise sqlite3.OperationalError('unable to open database file %s'%filename)
+      conn = sqlite3.connect(filename)
+   conn.row_factory = sqlite3.Row
+   conn.execute('PRAGMA query_only = ON')
+   conn.execute('PRAGMA mmap_size = %d'%mmap_size)
+   conn.execute('PRAGMA cache_size = -%d'%cache_kb)
+   return conn
+
+class ReadPool(object):
+   # hands each thread its own read-only connection to one file
+
+   def __init__(self, filename, mmap_size=MMAP_SIZE, cache_kb=CACHE_KB):
+      self.filename = filename
+      self.mmap_size = mmap_size
+      self.cache_kb = cache_kb
+      self.local = threading.local()
+
+   def connection(self):
+      conn = getattr(self.local, 'conn', None)
+      if conn is None:
+         conn = connect_readonly(self.filename, self.mmap_size, self.cache_kb)
+         self.local.conn = conn
+      return conn
+
+   def close(self):
+      # closes the calling thread's connection, others go with their threads
+      conn = getattr(self.local, 'conn', None)
+      if conn is not None:
+         conn.close()
+         self.local.conn = None
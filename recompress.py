@@ -0,0 +1,169 @@
+#!/usr/bin/env python2
+# -*- coding: UTF-8 -*-
+# Re-encode the raster tiles of a map/images mbtiles file to make it smaller
+# for offline deployments, e.g.
+#  recompress.py -m sat.mbtiles -o sat_q60.mbtiles --format jpeg --quality 60
+#  recompress.py -m sat.mbtiles --format webp -z 12 13
+# Tiles are read in map rowid ranges, each distinct image is encoded once in a
+# process pool and written back through a TileWriter. An image is kept as it
+# is when the new encoding is not smaller.
+
+import sqlite3
+import sys, os
+import argparse
+import io
+import time
+from multiprocessing import Pool
+from PIL import Image
+from download import MBTiles, TileCache, rowid_ranges, vacuum_into
+
+# GLOBALS
+args = object
+
+# (PIL format, metadata format name)
+formats = {
+   'jpeg': ('JPEG', 'jpg'),
+   'webp': ('WEBP', 'webp'),
+}
+
+def sniff_format(data):
+   # metadata format name of an encoded tile, from its first bytes
+   head = bytes(data[:12])
+   if head[:3] == b'\xff\xd8\xff':
+      return 'jpg'
+   if head[:8] == b'\x89PNG\r\n\x1a\n':
+      return 'png'
+   if head[:4] == b'RIFF' and head[8:12] == b'WEBP':
+      return 'webp'
+   return 'unknown'
+
+def encode(job):
+   # runs in the pool: returns (tile_id, new data or None to keep the original, original format)
+   tile_id, data, fmt, quality = job
+   original = sniff_format(data)
+   try:
+      image = Image.open(io.BytesIO(data))
+      if image.mode not in ('RGB', 'L'):
+         image = image.convert('RGB')
+      out = io.BytesIO()
+      if fmt == 'WEBP':
+         image.save(out, fmt, quality=quality, method=4)
+      else:
+         image.save(out, fmt, quality=quality, optimize=True)
+   except (IOError, ValueError):
+      return tile_id, None, original
+   encoded = out.getvalue()
+   if len(encoded) >= len(data):
+      return tile_id, None, original
+   return tile_id, encoded, original
+
+def load_images(db, tile_ids, step=500):
+   # tile_id -> data for a set of tile ids, without going through the map
+   images = {}
+   tile_ids = list(tile_ids)
+   for i in range(0, len(tile_ids), step):
+      part = tile_ids[i:i + step]
+      sql = 'SELECT tile_id, tile_data FROM images WHERE tile_id IN (%s)'%','.join('?' * len(part))
+      for tile_id, data in db.c.execute(sql, part).fetchall():
+         images[tile_id] = bytes(data)
+   return images
+
+def recompress(db, fmt='jpeg', quality=75, zooms=None, processes=None, chunk=2000, memo_bytes=64000000):
+   # returns {zoom: [tiles, converted, bytes_before, bytes_after]}
+   pil_format, format_name = formats[fmt]
+   if not db.schemaReady:
+      db.CheckSchema()
+   start = time.time()
+   # old tile_id -> new data ('' when the original is kept), shared images are
+   # encoded once; if one is evicted it is simply encoded again
+   memo = TileCache(memo_bytes)
+   kept_formats = {}
+   stats = {}
+   where = ''
+   params = []
+   if zooms:
+      where = 'AND map.zoom_level IN (%s)'%','.join('?' * len(zooms))
+      params = list(zooms)
+   pool = Pool(processes)
+   try:
+      with db.writer() as writer:
+         for low, high in rowid_ranges(db.c, 'map', chunk):
+            # length() of a blob is read from the record header, not the data
+            sql = """SELECT map.zoom_level, map.tile_column, map.tile_row, map.tile_id,
+                  length(images.tile_data) FROM map JOIN images ON images.tile_id = map.tile_id
+                  WHERE map.rowid >= ? AND map.rowid < ? %s"""%where
+            rows = db.c.execute(sql, [low, high] + params).fetchall()
+            results = {}
+            for tile_id in set(row[3] for row in rows):
+               encoded = memo.get(tile_id)
+               if encoded is not None:
+                  results[tile_id] = encoded
+            images = load_images(db, set(row[3] for row in rows if row[3] not in results))
+            jobs = [(tile_id, images[tile_id], pil_format, quality) for tile_id in images]
+            for tile_id, encoded, original in pool.imap_unordered(encode, jobs, 16):
+               if encoded is None:
+                  kept_formats[original] = kept_formats.get(original, 0) + 1
+               results[tile_id] = encoded or b''
+               memo.put(tile_id, results[tile_id])
+            for zoomLevel, tileColumn, tileRow, tile_id, size in rows:
+               counts = stats.setdefault(zoomLevel, [0, 0, 0, 0])
+               encoded = results[tile_id]
+               counts[0] += 1
+               counts[2] += size
+               if encoded:
+                  counts[1] += 1
+                  counts[3] += len(encoded)
+                  writer.add(zoomLevel, tileColumn, tileRow, encoded)
+               else:
+                  counts[3] += size
+   finally:
+      pool.close()
+      pool.join()
+
+   others = [name for name in kept_formats if name != format_name]
+   if others:
+      print('kept originals in %s, format metadata left as it was'%\
+            ', '.join('%s (%s images)'%(name, kept_formats[name]) for name in others))
+   else:
+      db.SetMetaData('format', format_name)
+   print('zoom      tiles  converted      before       after   saved')
+   saved = 0
+   for zoom in sorted(stats):
+      tiles, converted, before, after = stats[zoom]
+      saved += before - after
+      print('%4s %10s %10s %11s %11s %6.1f%%'%(zoom,tiles,converted,before,after,
+            100.0 * (before - after) / before if before else 0.0))
+   print('%s bytes saved in %2.1f seconds'%(saved,time.time()-start))
+   return stats
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Re-encode the raster tiles of an mbtiles file.")
+    parser.add_argument("-m", "--mbtiles", help="mbtiles filename.", required=True)
+    parser.add_argument("-o", "--output", help="Recompress a copy written here, -m is left alone.")
+    parser.add_argument("--format", help="Target format. (Default=jpeg)", choices=sorted(formats.keys()), default='jpeg')
+    parser.add_argument("-q", "--quality", help="Encoder quality 1-100. (Default=75)", type=int, default=75)
+    parser.add_argument("-z", "--zoom", help="Only these zoom levels.", type=int, nargs='*')
+    parser.add_argument("-p", "--processes", help="Encoder processes. (Default=cpu count)", type=int)
+    parser.add_argument("--chunk", help="Map rows per step. (Default=2000)", type=int, default=2000)
+    return parser.parse_args()
+
+def main():
+   global args
+   args = parse_args()
+   if not os.path.isfile(args.mbtiles):
+      print('%s not found'%args.mbtiles)
+      sys.exit(1)
+   filename = args.mbtiles
+   if args.output:
+      # the source is only read: no schema check, no switch to WAL
+      conn = sqlite3.connect(args.mbtiles)
+      vacuum_into(conn, args.output)
+      conn.close()
+      filename = args.output
+   db = MBTiles(filename)
+   recompress(db, args.format, args.quality, args.zoom, args.processes, args.chunk)
+   db.collect_garbage()
+   sys.exit(0)
+
+if __name__ == "__main__":
+   main()
@@ -0,0 +1,194 @@
+#!/usr/bin/env python2
+# -*- coding: UTF-8 -*-
+# A tile set spread over several mbtiles files (shards) in one directory,
+# with the GetTile/SetTile/TileExists API of download.MBTiles.
+# Tiles are routed by zoom band or by the quadkey of their ancestor at a
+# prefix zoom; shards.json in the directory records the scheme and the
+# shards made so far, so one region can be rebuilt, copied or rsynced as a
+# file of its own. Each shard is its own sqlite file, so processes writing
+# to different shards do not wait on each other:
+#    db = ShardedMBTiles('work/sat', scheme='quadkey', prefix_zoom=6)
+#    db.SetTile(13, x, y, data)
+#    for name in db.shards_for_bbox(bbox, 13): ... MBTiles(db.shard_path(name))
+
+import sys, os
+import fcntl
+import json
+import time
+from download import MBTiles, quadkey, bbox_tile_limits
+
+MANIFEST = 'shards.json'
+
+class ShardedMBTiles(object):
+
+   def __init__(self, directory, scheme=None, bands=None, prefix_zoom=6, cache_bytes=0, readonly=False):
+      # scheme is 'zoom' (bands: list of [first, last] zooms) or 'quadkey'
+      # (tiles below prefix_zoom share the 'base' shard); an existing
+      # manifest wins over the arguments
+      self.directory = directory
+      self.cache_bytes = cache_bytes
+      self.readonly = readonly
+      self.dbs = {}
+      manifest = self.read_manifest()
+      if manifest is None:
+         if scheme is None:
+            scheme = 'zoom'
+         if scheme not in ('zoom', 'quadkey'):
+            raise ValueError('scheme must be zoom or quadkey')
+         if scheme == 'zoom' and not bands:
+            bands = [[0, 9], [10, 12], [13, 13], [14, 22]]
+         manifest = {'scheme': scheme, 'bands': bands, 'prefix_zoom': prefix_zoom, 'shards': {}}
+         if not readonly:
+            if not os.path.isdir(directory):
+               os.makedirs(directory)
+            self.write_manifest(manifest)
+      self.manifest = manifest
+      self.scheme = manifest['scheme']
+      self.bands = manifest['bands']
+      self.prefix_zoom = manifest['prefix_zoom']
+
+   def __del__(self):
+      self.close()
+
+   def read_manifest(self):
+      path = os.path.join(self.directory, MANIFEST)
+      if not os.path.isfile(path):
+         return None
+      with open(path, 'r') as fp:
+         return json.load(fp)
+
+   def write_manifest(self, manifest):
+      # write a temporary and rename it so readers never see half a file
+      path = os.path.join(self.directory, MANIFEST)
+      tmp = '%s.%s'%(path, os.getpid())
+      with open(tmp, 'w') as fp:
+         json.dump(manifest, fp, indent=2, sort_keys=True)
+      os.rename(tmp, path)
+
+   def shard_name(self, zoomLevel, tileColumn, tileRow):
+      zoomLevel = int(zoomLevel)
+      if self.scheme == 'zoom':
+         for first, last in self.bands:
+            if first <= zoomLevel <= last:
+               return 'z%s-z%s'%(first, last)
+         raise ValueError('zoom %s is in no band of %s'%(zoomLevel, self.directory))
+      if zoomLevel < self.prefix_zoom:
+         return 'base'
+      shift = zoomLevel - self.prefix_zoom
+      return 'q%s'%quadkey(self.prefix_zoom, int(tileColumn) >> shift, int(tileRow) >> shift)
+
+   def shard_path(self, name):
+      return os.path.join(self.directory, '%s.mbtiles'%name)
+
+   def shard(self, name, create=False):
+      # the open MBTiles for a shard, None if it does not exist and create is False
+      db = self.dbs.get(name)
+      if db is not None:
+         return db
+      path = self.shard_path(name)
+      if not os.path.isfile(path):
+         if not create:
+            return None
+         if self.readonly:
+            raise RuntimeError('%s is read only'%self.directory)
+      db = MBTiles(path, cache_bytes=self.cache_bytes, readonly=self.readonly)
+      if not self.readonly:
+         db.CheckSchema()
+      self.dbs[name] = db
+      if name not in self.manifest['shards'] and not self.readonly:
+         self.add_to_manifest(name)
+      return db
+
+   def add_to_manifest(self, name):
+      # other processes add shards of their own: re-read and rewrite under
+      # an exclusive lock on shards.json.lock, or one of them loses its entry
+      with open(os.path.join(self.directory, MANIFEST + '.lock'), 'a') as lock:
+         fcntl.flock(lock, fcntl.LOCK_EX)
+         try:
+            manifest = self.read_manifest() or self.manifest
+            manifest['shards'][name] = {'file': os.path.basename(self.shard_path(name)), 'created': time.time()}
+            self.write_manifest(manifest)
+         finally:
+            fcntl.flock(lock, fcntl.LOCK_UN)
+      self.manifest = manifest
+
+   def shard_for(self, zoomLevel, tileColumn, tileRow, create=False):
+      return self.shard(self.shard_name(zoomLevel, tileColumn, tileRow), create)
+
+   def shard_names(self):
+      # as on disk, other processes may have made shards since we looked
+      self.manifest = self.read_manifest() or self.manifest
+      return sorted(self.manifest['shards'].keys())
+
+   def shards_for_bbox(self, bbox, zoom):
+      # names of the shards holding tiles of bbox (west, south, east, north) at zoom,
+      # to hand one to each writer process
+      west, south, east, north = bbox
+      # bbox_tile_limits' upper bounds are exclusive
+      xmin, xmax, ymin, ymax = bbox_tile_limits(west, south, east, north, zoom)
+      if self.scheme == 'zoom' or zoom < self.prefix_zoom:
+         return [self.shard_name(zoom, xmin, ymin)]
+      shift = zoom - self.prefix_zoom
+      names = set()
+      for x in range(xmin >> shift, ((xmax - 1) >> shift) + 1):
+         for y in range(ymin >> shift, ((ymax - 1) >> shift) + 1):
+            names.add(self.shard_name(self.prefix_zoom, x, y))
+      return sorted(names)
+
+   def GetTile(self, zoomLevel, tileColumn, tileRow):
+      db = self.shard_for(zoomLevel, tileColumn, tileRow)
+      if db is None:
+         raise RuntimeError("Tile not found")
+      return db.GetTile(zoomLevel, tileColumn, tileRow)
+
+   def SetTile(self, zoomLevel, tileColumn, tileRow, data):
+      db = self.shard_for(zoomLevel, tileColumn, tileRow, create=True)
+      db.SetTile(zoomLevel, tileColumn, tileRow, data)
+
+   def TileExists(self, zoomLevel, tileColumn, tileRow):
+      db = self.shard_for(zoomLevel, tileColumn, tileRow)
+      if db is None:
+         return None
+      return db.TileExists(zoomLevel, tileColumn, tileRow)
+
+   def DeleteTile(self, zoomLevel, tileColumn, tileRow):
+      db = self.shard_for(zoomLevel, tileColumn, tileRow)
+      if db is None:
+         raise RuntimeError("Tile not found")
+      db.DeleteTile(zoomLevel, tileColumn, tileRow)
+
+   def set_tiles(self, tiles, batch_size=500, commit_interval=5.0):
+      # one TileWriter per shard, tiles may come in any order
+      writers = {}
+      try:
+         for zoomLevel, tileColumn, tileRow, data in tiles:
+            name = self.shard_name(zoomLevel, tileColumn, tileRow)
+            writer = writers.get(name)
+            if writer is None:
+               writer = self.shard(name, create=True).writer(batch_size, commit_interval)
+               writer.__enter__()
+               writers[name] = writer
+            writer.add(zoomLevel, tileColumn, tileRow, data)
+      finally:
+         for writer in writers.values():
+            writer.__exit__(None, None, None)
+      return sum(writer.written for writer in writers.values())
+
+   def CountTiles(self, zoom):
+      total = 0
+      for name in self.shard_names():
+         db = self.shard(name)
+         if db is not None:
+            total += db.CountTiles(zoom)
+      return total
+
+   def Commit(self):
+      for db in self.dbs.values():
+         db.Commit()
+
+   def close(self):
+      # commit and drop the open shards, MBTiles closes on delete
+      for db in self.dbs.values():
+         if not self.readonly:
+            db.Commit()
+      self.dbs = {}
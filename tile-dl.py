@@ -19,6 +19,8 @@ import math
 from geojson import Feature, Point, FeatureCollection, Polygon
 import geojson
 from download import MBTiles, WMTS, fetch_quad_for
+import verify
+from cover import circle_cover
 import shutil
 import json
 import time
@@ -233,48 +235,25 @@ def create_clone():
 
 
 def scan_verify():
+   # verify.py sniffs headers and decodes only the doubtful tiles
    global src # the opened url for satellite images
    if args.fix:
       create_clone()
-   replaced = bad = ok = empty = html = unfixable = 0
-   mbTiles = MBTiles(args.mbtiles)
+   replaced = unfixable = 0
    print('Opening database %s'%args.mbtiles)
-   for zoom in sorted(bounds.keys()):
-      #if zoom == 5: sys.exit()
-      bad = ok = empty = html = 0
-      for tileY in range(bounds[zoom]['minY'],bounds[zoom]['maxY'] + 1):
-         #print("New Y:%s on zoom:%s"%(tileY,zoom))
-         for tileX in range(bounds[zoom]['minX'],bounds[zoom]['maxX'] + 1):
-               #print('tileX:%s'%tileX)
-               replace = False
-               raw = mbTiles.GetTile(zoom, tileX, tileY)
-               try:
-                  image = Image.open(StringIO.StringIO(raw))
-                  ok += 1
-                  if len(raw) < 800: 
-                     replace=True
-                  else:
-                     continue
-               except Exception as e:
-                  bad += 1
-                  replace = True
-                  line = bytearray(raw)
-                  if line.find("DOCTYPE") != -1:
-                     html +=1
-                  if args.fix and replace:
-                        success = replace_tile(src,zoom,tileX,tileY)
-                        if success:
-                           bad_ref.write('%s,%s,%s\n'%(zoom,tileX,tileY))
-                           replaced += 1
-                        else:
-                           bad_ref.write('%s,%s,%s\n'%(zoom,tileX,tileY))
-                           unfixable += 1
-                        if tileY % 20 == 0:
-                           print('replaced:%s  ok:%s'%(replaced,ok))
-      print 'bad',bad,'ok',ok, 'empty',empty,'html',html, 'unfixable',unfixable,'zoom',zoom,'replaced',replaced
-   print 'bad',bad,'ok',ok, 'empty',empty,'html',html, 'unfixable',unfixable
+   bad = verify.verify(args.mbtiles, out='./work/verify.csv')
    if args.fix:
+      for zoom, tileX, tileY, reason in bad:
+         success = replace_tile(src,zoom,tileX,tileY)
+         bad_ref.write('%s,%s,%s,%s\n'%(zoom,tileX,tileY,reason))
+         if success:
+            replaced += 1
+         else:
+            unfixable += 1
+         if (replaced + unfixable) % 20 == 0:
+            print('replaced:%s  unfixable:%s'%(replaced,unfixable))
       bad_ref.close()
+   print('bad:%s replaced:%s unfixable:%s (list in ./work/verify.csv)'%(len(bad),replaced,unfixable))
    
 def replace_tile(src,zoom,tileX,tileY):
    global total_tiles
@@ -310,11 +289,10 @@ def replace_tile(src,zoom,tileX,tileY):
 def download_tiles(src,lat_deg,lon_deg,zoom,radius):
    global mbTiles
    global total_tiles
-   tileX_min,tileX_max,tileY_min,tileY_max = bounds(lat_deg,lon_deg,radius,zoom)
-   for tileX in range(tileX_min,tileX_max+1):
-      for tileY in range(tileY_min,tileY_max+1):
-         print('tileX:%s tileY:%s'%(tileX,tileY))
-         replace_tile(src,zoom,tileX,tileY)
+   # the tiles within radius, not the square around the circle
+   for tileX, tileY in sorted(circle_cover(lat_deg,lon_deg,radius,zoom).tiles(zoom)):
+      print('tileX:%s tileY:%s'%(tileX,tileY))
+      replace_tile(src,zoom,tileX,tileY)
 
 def set_up_target_db(name='sentinel'):
    global mbTiles
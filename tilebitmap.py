@@ -0,0 +1,90 @@
+#!/usr/bin/env python
+# -*- coding: UTF-8 -*-
+# A set of tiles kept in an sqlite table as one bit per tile column, one row
+# per (zoom_level, tile_row). A zoom 13 row is 1 KB whatever is marked in it.
+# Used to mark the blank (ocean) tiles of download.MBTiles.
+
+class TileBitmap(object):
+   # connect is a function returning the sqlite connection to use, so a
+   # readonly MBTiles can hand over its per-thread reader
+
+   def __init__(self, connect, table):
+      self.connect = connect
+      self.table = table
+      self.pending = {} # (zoom, tile_row) -> bytearray, changed but not written
+
+   def create(self):
+      self.connect().execute("""CREATE TABLE IF NOT EXISTS %s (zoom_level INTEGER, tile_row INTEGER,
+            bits BLOB, PRIMARY KEY (zoom_level, tile_row))"""%self.table)
+
+   def load_row(self, zoom, tileRow):
+      key = (int(zoom), int(tileRow))
+      bits = self.pending.get(key)
+      if bits is not None:
+         return bits
+      row = self.connect().execute('SELECT bits FROM %s WHERE zoom_level = ? AND tile_row = ?'%self.table,
+            key).fetchone()
+      if row is None:
+         return None
+      return bytearray(row[0])
+
+   def __contains__(self, tile):
+      zoom, tileColumn, tileRow = tile
+      bits = self.load_row(zoom, tileRow)
+      if bits is None or tileColumn >> 3 >= len(bits):
+         return False
+      return bits[tileColumn >> 3] & (1 << (tileColumn & 7)) != 0
+
+   def columns(self, zoom, tileRow, minX, maxX):
+      # marked columns of one row between minX and maxX inclusive
+      bits = self.load_row(zoom, tileRow)
+      if bits is None:
+         return
+      for tileColumn in range(minX, min(maxX + 1, len(bits) * 8)):
+         if bits[tileColumn >> 3] & (1 << (tileColumn & 7)):
+            yield tileColumn
+
+   def change(self, zoom, tileColumn, tileRow, value):
+      # set or clear one bit, written on flush; returns whether it changed
+      key = (int(zoom), int(tileRow))
+      bits = self.load_row(*key)
+      if bits is None:
+         if not value:
+            return False
+         bits = bytearray(((1 << key[0]) + 7) // 8)
+      mask = 1 << (tileColumn & 7)
+      if bool(bits[tileColumn >> 3] & mask) == bool(value):
+         return False
+      if value:
+         bits[tileColumn >> 3] |= mask
+      else:
+         bits[tileColumn >> 3] &= ~mask & 0xff
+      self.pending[key] = bits
+      return True
+
+   def add(self, zoom, tileColumn, tileRow):
+      return self.change(zoom, tileColumn, tileRow, True)
+
+   def discard(self, zoom, tileColumn, tileRow):
+      return self.change(zoom, tileColumn, tileRow, False)
+
+   def flush(self):
+      # write the changed rows, the caller commits
+      conn = self.connect()
+      for (zoom, tileRow), bits in self.pending.items():
+         if any(bits):
+            conn.execute('INSERT OR REPLACE INTO %s (zoom_level, tile_row, bits) VALUES (?, ?, ?)'%self.table,
+                  (zoom, tileRow, bytes(bits)))
+         else:
+            conn.execute('DELETE FROM %s WHERE zoom_level = ? AND tile_row = ?'%self.table, (zoom, tileRow))
+      self.pending = {}
+
+   def clear_zoom(self, zoom):
+      self.pending = dict((key, bits) for key, bits in self.pending.items() if key[0] != int(zoom))
+      self.connect().execute('DELETE FROM %s WHERE zoom_level = ?'%self.table, (zoom,))
+
+   def count(self, zoom):
+      total = 0
+      for row in self.connect().execute('SELECT bits FROM %s WHERE zoom_level = ?'%self.table, (zoom,)):
+         total += sum(bin(byte).count('1') for byte in bytearray(row[0]))
+      return total
@@ -1,11 +1,14 @@
 #!/usr/bin/env  python
-# Calculate the download time for eah region at 10 tiles per second
+# Calculate the download time for eah region (the tiles of its polygon or box)
+# at TILES_PER_SECOND (default 10),
+# set it to the rate download.py reports once its limiter has settled
 
 import os,sys
 import json
 import shutil
 import subprocess
 import math
+from cover import region_cover
 
 # error out if environment is missing
 MR_SSD = os.environ["MR_SSD"]
@@ -14,6 +17,7 @@ bbox_limits = {}
 
 REGION_INFO = os.path.join(MR_SSD,'../resources/regions.json')
 REGION_LIST = os.environ.get("REGION_LIST")
+RATE = float(os.environ.get("TILES_PER_SECOND", "10"))
 
 def sec2hms(n):
     days = n // (24 * 3600) 
@@ -52,15 +56,17 @@ def record_bbox_debug_info(regions):
    spd = 3600 * 24
    for region in regions.keys():
       cur_box = regions[region]
+      # tiles of the region's polygon (or box), not of the box around it
+      region_tiles = region_cover(cur_box, 13)
       tot_tiles = 0
       for zoom in range(1,14):
          xmin,xmax,ymin,ymax = bbox_tile_limits(cur_box['west'],cur_box['south'],\
                cur_box['east'],cur_box['north'],zoom)
          #print(xmin,xmax,ymin,ymax,zoom)
-         tiles = (xmax-xmin)*(ymax-ymin)
+         tiles = region_tiles.count(zoom)
          bbox_limits[zoom] = { 'minX': xmin,'maxX':xmax,'minY':ymin,'maxY':ymax,                              'count':tot_tiles}
          tot_tiles += tiles
-      seconds = tot_tiles / 10
+      seconds = int(tot_tiles / RATE)
       print region, tot_tiles, sec2hms(seconds)
 
    with open('./work/time_limits','w') as fp:
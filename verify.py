@@ -0,0 +1,181 @@
+#!/usr/bin/env python2
+# -*- coding: UTF-8 -*-
+# Find broken raster tiles in an mbtiles file (map/images or flat tiles).
+# Blobs are read in one pass of rowid ranges and judged from their first and
+# last bytes: the magic number, the JPEG markers up to the scan or the PNG
+# IHDR, and the end of image marker. Only tiles the headers cannot vouch for
+# are decoded with PIL, in a process pool. Bad tiles are written as csv:
+#    zoom,x,y,reason   (reason: html, truncated, undersized, undecodable)
+#  verify.py -m sat.mbtiles -o bad_tiles.csv
+
+import sys, os
+import argparse
+import io
+import time
+from multiprocessing import Pool
+from PIL import Image
+from download import tile_chunks, looks_like_html
+from readpool import connect_readonly
+
+# GLOBALS
+args = object
+
+TILE_SIZE = 256
+MIN_SIZE = 800 # smaller tiles are flagged undersized (see scan_verify)
+# JPEG start of frame markers, they carry the image size
+SOF_MARKERS = set(range(0xc0, 0xd0)) - set([0xc4, 0xc8, 0xcc])
+PNG_SIGNATURE = b'\x89PNG\r\n\x1a\n'
+PNG_IEND = b'IEND\xaeB`\x82'
+
+def jpeg_header(data):
+   # (width, height) from the frame header, 'truncated' if the markers run
+   # off the end of the data, None if they make no sense
+   n = len(data)
+   i = 2
+   size = None
+   while i + 4 <= n:
+      if data[i] != 0xff:
+         return None
+      marker = data[i + 1]
+      if marker == 0xff: # fill byte
+         i += 1
+         continue
+      if marker == 0x01 or 0xd0 <= marker <= 0xd8:
+         i += 2
+         continue
+      length = (data[i + 2] << 8) | data[i + 3]
+      if marker in SOF_MARKERS:
+         if i + 9 > n:
+            return 'truncated'
+         size = ((data[i + 7] << 8) | data[i + 8], (data[i + 5] << 8) | data[i + 6])
+      if marker == 0xda: # start of scan, compressed data follows
+         return size
+      i += 2 + length
+   return 'truncated'
+
+def png_header(data):
+   # (width, height) from IHDR, or None
+   if len(data) < 24 or data[12:16] != bytearray(b'IHDR'):
+      return None
+   width = (data[16] << 24) | (data[17] << 16) | (data[18] << 8) | data[19]
+   height = (data[20] << 24) | (data[21] << 16) | (data[22] << 8) | data[23]
+   return (width, height)
+
+def sniff(raw, min_size=MIN_SIZE):
+   # reason the tile is bad, 'decode' when only decoding can tell, None if fine
+   if not raw:
+      return 'truncated'
+   if looks_like_html(raw):
+      return 'html'
+   data = bytearray(raw)
+   if data[:3] == bytearray(b'\xff\xd8\xff'):
+      size = jpeg_header(data)
+      if size == 'truncated' or not bytes(data).rstrip(b'\x00').endswith(b'\xff\xd9'):
+         return 'truncated'
+   elif data[:8] == bytearray(PNG_SIGNATURE):
+      size = png_header(data)
+      if not bytes(data[-8:]) == PNG_IEND:
+         return 'truncated'
+   elif data[:4] == bytearray(b'RIFF') and data[8:12] == bytearray(b'WEBP'):
+      riff_size = data[4] | (data[5] << 8) | (data[6] << 16) | (data[7] << 24)
+      if riff_size + 8 > len(data):
+         return 'truncated'
+      size = (TILE_SIZE, TILE_SIZE) # header says nothing more without parsing chunks
+   else:
+      return 'decode'
+   if len(data) < min_size:
+      return 'undersized'
+   if size != (TILE_SIZE, TILE_SIZE):
+      return 'decode'
+   return None
+
+def decode(job):
+   # runs in the pool: full decode of a tile the headers could not vouch for
+   key, data = job
+   try:
+      image = Image.open(io.BytesIO(data))
+      image.load()
+   except Exception:
+      return key, 'undecodable'
+   return key, None
+
+def verify(filename, zooms=None, out=None, processes=None, chunk=2000, min_size=MIN_SIZE):
+   # returns [(zoom, x, y, reason)], also written to the file out as csv
+   conn = connect_readonly(filename)
+   c = conn.cursor()
+   fp = None
+   if out:
+      fp = open(out, 'w')
+      fp.write('zoom,x,y,reason\n')
+   pool = Pool(processes)
+   bad = []
+   stats = {} # zoom -> [tiles, decoded, {reason: count}, seconds]
+   start = mark = time.time()
+   try:
+      for rows in tile_chunks(c, zooms, chunk):
+         found = []
+         suspects = []
+         chunk_tiles = {}
+         for zoom, tileColumn, tileRow, data in rows:
+            if zoom not in stats:
+               stats[zoom] = [0, 0, {'html': 0, 'truncated': 0, 'undersized': 0, 'undecodable': 0}, 0.0]
+            stats[zoom][0] += 1
+            chunk_tiles[zoom] = chunk_tiles.get(zoom, 0) + 1
+            reason = sniff(data, min_size)
+            if reason == 'decode':
+               stats[zoom][1] += 1
+               suspects.append(((zoom, tileColumn, tileRow), bytes(data)))
+            elif reason:
+               found.append((zoom, tileColumn, tileRow, reason))
+         for key, reason in pool.imap_unordered(decode, suspects, 8):
+            if reason:
+               found.append(key + (reason,))
+         for row in sorted(found):
+            stats[row[0]][2][row[3]] += 1
+            if fp:
+               fp.write('%s,%s,%s,%s\n'%row)
+         bad += found
+         # the chunk's time goes to its zooms by their share of its tiles
+         now = time.time()
+         for zoom, tiles in chunk_tiles.items():
+            stats[zoom][3] += (now - mark) * tiles / len(rows)
+         mark = now
+   finally:
+      pool.close()
+      pool.join()
+      if fp:
+         fp.close()
+      conn.close()
+   print('zoom      tiles  decoded  html  truncated  undersized  undecodable  seconds')
+   for zoom in sorted(stats):
+      tiles, decoded, counts, seconds = stats[zoom]
+      print('%4s %10s %8s %5s %10s %11s %12s %8.1f'%(zoom,tiles,decoded,counts['html'],
+            counts['truncated'],counts['undersized'],counts['undecodable'],seconds))
+   print('%s tiles in %2.1f seconds'%(sum(stat[0] for stat in stats.values()),time.time()-start))
+   print('%s bad tiles'%len(bad))
+   return bad
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Find broken raster tiles in an mbtiles file.")
+    parser.add_argument("-m", "--mbtiles", help="mbtiles filename.", required=True)
+    parser.add_argument("-o", "--output", help="Write bad tiles here as csv. (Default=stdout)")
+    parser.add_argument("-z", "--zoom", help="Only these zoom levels.", type=int, nargs='*')
+    parser.add_argument("-p", "--processes", help="Decoder processes. (Default=cpu count)", type=int)
+    parser.add_argument("--min-size", help="Smaller tiles are undersized. (Default=%s)"%MIN_SIZE, type=int, default=MIN_SIZE)
+    return parser.parse_args()
+
+def main():
+   global args
+   args = parse_args()
+   if not os.path.isfile(args.mbtiles):
+      print('%s not found'%args.mbtiles)
+      sys.exit(1)
+   bad = verify(args.mbtiles, args.zoom, args.output, args.processes, min_size=args.min_size)
+   if not args.output:
+      print('zoom,x,y,reason')
+      for row in bad:
+         print('%s,%s,%s,%s'%row)
+   sys.exit(0)
+
+if __name__ == "__main__":
+   main()